@@ -0,0 +1,57 @@
+"""
+Compare the generic djpgtree_next function with a per-table allocator created by
+CreateTreePathAllocator, allocating a path under parents of increasing width.
+"""
+import argparse
+
+from .common import test_database, timed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--widths", type=int, nargs="+", default=[10, 1000, 100000])
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    with test_database() as connection:
+        from django_pgtree.models import GAP, PAD_LENGTH
+        from django_pgtree.operations import allocator_function_name
+        from testproject.testapp.models import TestModel
+
+        table = TestModel._meta.db_table
+        print("{:>10} {:>14} {:>14}".format("children", "generic (ms)", "table (ms)"))
+        for width in args.widths:
+            TestModel.objects.all().delete()
+            parent = TestModel.objects.create(name="parent")
+            TestModel.objects.bulk_create_tree(
+                (TestModel(name=str(i), parent=parent) for i in range(width)),
+                batch_size=5000,
+            )
+            prefix = ".".join(parent.tree_path)
+
+            with connection.cursor() as cursor:
+                cursor.execute("ANALYZE {}".format(table))
+
+                def generic():
+                    cursor.execute(
+                        "SELECT djpgtree_next(%s, %s, %s, %s)",
+                        [table, prefix, GAP, PAD_LENGTH],
+                    )
+
+                def specialised():
+                    cursor.execute(
+                        "SELECT {}(%s, %s, %s)".format(allocator_function_name(table)),
+                        [prefix, GAP, PAD_LENGTH],
+                    )
+
+                print(
+                    "{:>10} {:>14.3f} {:>14.3f}".format(
+                        width,
+                        timed(generic, args.repeat),
+                        timed(specialised, args.repeat),
+                    )
+                )
+
+
+if __name__ == "__main__":
+    main()
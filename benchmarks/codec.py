@@ -0,0 +1,87 @@
+"""
+Compare label codecs: the size of the table and its tree_path indexes, and the time
+taken by descendant and ancestor lookups, for the same tree stored with each one.
+"""
+import argparse
+
+from .common import test_database, timed
+
+
+def build_tree(model, width, depth):
+    # A tree with width root nodes, each of which has width children, and so on
+    # down to the given depth
+    level = [None]
+    for _ in range(depth):
+        nodes = [
+            model(name=str(i), parent=parent) for parent in level for i in range(width)
+        ]
+        model.objects.bulk_create_tree(nodes, batch_size=5000)
+        level = nodes
+    return level
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--codecs", nargs="+", default=["decimal", "base62"])
+    parser.add_argument("--width", type=int, default=6)
+    parser.add_argument("--depth", type=int, default=6)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    with test_database() as connection:
+        from testproject.testapp.models import TestModel
+
+        table = TestModel._meta.db_table
+        print(
+            "{:>8} {:>12} {:>12} {:>12} {:>16} {:>16}".format(
+                "codec",
+                "table (kB)",
+                "gist (kB)",
+                "btree (kB)",
+                "descendants (ms)",
+                "ancestors (ms)",
+            )
+        )
+        for codec in args.codecs:
+            TestModel.label_codec = codec
+            TestModel.objects.all().delete()
+            leaves = build_tree(TestModel, args.width, args.depth)
+            root = TestModel.objects.roots().first()
+            leaf = leaves[len(leaves) // 2]
+
+            with connection.cursor() as cursor:
+                cursor.execute("VACUUM ANALYZE {}".format(table))
+                cursor.execute(
+                    """
+                    SELECT
+                        pg_relation_size(%s::regclass),
+                        pg_relation_size('tree_path_idx'::regclass),
+                        pg_relation_size(i.indexrelid)
+                    FROM pg_index i
+                    WHERE i.indrelid = %s::regclass AND i.indisunique
+                        AND NOT i.indisprimary
+                    """,
+                    [table, table],
+                )
+                table_size, gist_size, btree_size = cursor.fetchone()
+
+            def descendants():
+                list(root.descendants.values_list("pk", flat=True)[:1000])
+
+            def ancestors():
+                list(leaf.ancestors.values_list("pk", flat=True))
+
+            print(
+                "{:>8} {:>12} {:>12} {:>12} {:>16.3f} {:>16.3f}".format(
+                    codec,
+                    table_size // 1024,
+                    gist_size // 1024,
+                    btree_size // 1024,
+                    timed(descendants, args.repeat),
+                    timed(ancestors, args.repeat),
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+"""
+Shared setup for the benchmark scripts in this directory.
+
+Each benchmark runs against a throwaway test database created from the test
+project's settings, so it needs the same PostgreSQL server (with the ltree
+extension available) that the test suite does. Run them from the repository root,
+e.g. ``python -m benchmarks.allocator``.
+"""
+import contextlib
+import os
+import time
+
+import django
+
+
+@contextlib.contextmanager
+def test_database():
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "testproject.settings")
+    django.setup()
+
+    from django.db import connection
+    from django.test.utils import setup_test_environment, teardown_test_environment
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        yield connection
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+def timed(fn, repeat):
+    """Call fn() repeat times, returning the mean duration in milliseconds."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) * 1000 / repeat
@@ -0,0 +1,71 @@
+"""
+Show which index the planner picks for each of TreeNode's built-in relationship
+queries, under each combination of tree_path indexes.
+"""
+import argparse
+import re
+
+from .common import test_database
+
+INDEX_SCAN = re.compile(
+    r"(?:Index (?:Only )?Scan(?: Backward)? using|Index Scan on) (\S+)"
+)
+
+
+def plan_summary(queryset):
+    plan = queryset.explain()
+    used = sorted(set(INDEX_SCAN.findall(plan)))
+    return ", ".join(used) or ("seq scan" if "Seq Scan" in plan else "?")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--width", type=int, default=8)
+    parser.add_argument("--depth", type=int, default=5)
+    parser.add_argument("--siglen", type=int, default=256)
+    args = parser.parse_args()
+
+    with test_database() as connection:
+        from django_pgtree.indexes import tree_path_indexes
+        from testproject.testapp.models import TestModel
+
+        from .codec import build_tree
+
+        configurations = [
+            ("gist", tree_path_indexes()),
+            (
+                "gist siglen={}".format(args.siglen),
+                tree_path_indexes(siglen=args.siglen),
+            ),
+            ("btree only", tree_path_indexes(gist=False)),
+            ("gist + depth", tree_path_indexes(depth=True)),
+        ]
+
+        leaves = build_tree(TestModel, args.width, args.depth)
+        node = leaves[len(leaves) // 2].parent
+        queries = [
+            ("children", node.children),
+            ("descendants", node.descendants),
+            ("ancestors", node.ancestors),
+            ("siblings", node.siblings),
+            ("roots", TestModel.objects.roots()),
+        ]
+
+        current = TestModel._meta.indexes
+        for label, indexes in configurations:
+            with connection.schema_editor() as editor:
+                for index in current:
+                    editor.remove_index(TestModel, index)
+                for index in indexes:
+                    editor.add_index(TestModel, index)
+            current = indexes
+            with connection.cursor() as cursor:
+                cursor.execute("ANALYZE {}".format(TestModel._meta.db_table))
+
+            print(label)
+            for name, queryset in queries:
+                print("  {:<12} {}".format(name, plan_summary(queryset)))
+
+
+if __name__ == "__main__":
+    main()
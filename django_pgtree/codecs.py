@@ -0,0 +1,82 @@
+"""
+Label codecs, which turn the integer value of each level of a tree path into the
+text of its ltree label and back.
+
+Every codec has to keep labels in the same order as their values, as ltree
+compares them (byte by byte, then shorter first), since that's what sibling order
+is. Each one also needs a counterpart in the ``djpgtree_encode_label`` and
+``djpgtree_decode_label`` SQL functions, so that paths can be allocated in the
+database.
+"""
+import string
+
+# How many digits decimal labels are padded to; enough for any bigint
+PAD_LENGTH = 18
+
+
+class DecimalCodec:
+    """
+    Zero-padded decimal labels, like ``000000001000000000``. This is the format
+    django-pgtree has always used.
+    """
+
+    name = "decimal"
+
+    def encode(self, value, pad_length=PAD_LENGTH):
+        return str(value).zfill(pad_length)
+
+    def decode(self, label):
+        return int(label)
+
+    def sql_encode(self, value, pad_length):
+        return "LPAD(({})::text, {}, '0')".format(value, pad_length)
+
+    def sql_decode(self, label):
+        return "({})::bigint".format(label)
+
+
+class Base62Codec:
+    """
+    Base-62 labels, prefixed with a single digit giving their length, like ``615ftgG``
+    for a billion. Longer numbers get a higher prefix, so they still sort after
+    shorter ones, and any value below 62 ** 6 (about 56 billion) takes 7 bytes rather
+    than decimal's 18.
+    """
+
+    name = "base62"
+    # In ASCII order, so that labels compare the same way as their values
+    alphabet = string.digits + string.ascii_uppercase + string.ascii_lowercase
+    digit_values = {digit: value for value, digit in enumerate(alphabet)}
+
+    def encode(self, value, pad_length=PAD_LENGTH):  # pylint: disable=unused-argument
+        if value < 0:
+            raise ValueError("Can't encode a negative label value")
+        digits = []
+        while True:
+            value, digit = divmod(value, 62)
+            digits.append(self.alphabet[digit])
+            if not value:
+                break
+        return self.alphabet[len(digits)] + "".join(reversed(digits))
+
+    def decode(self, label):
+        value = 0
+        for digit in label[1:]:
+            value = value * 62 + self.digit_values[digit]
+        return value
+
+    def sql_encode(self, value, pad_length):
+        return "djpgtree_encode_label({}, 'base62', {})".format(value, pad_length)
+
+    def sql_decode(self, label):
+        return "djpgtree_decode_label({}, 'base62')".format(label)
+
+
+CODECS = {codec.name: codec for codec in (DecimalCodec(), Base62Codec())}
+
+
+def get_codec(name):
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError("Unknown label codec {!r}".format(name))
@@ -1,6 +1,121 @@
-from django.db.models import Field, Lookup
+from collections.abc import Sequence
+from functools import total_ordering
+
+from django.db.models import Field, IntegerField, Lookup, Transform
 from django.utils.translation import gettext_lazy as _
 
+from .codecs import get_codec
+from .lquery import LQuery, LTxtQuery
+
+
+@total_ordering
+class TreePath(Sequence):
+    """
+    A tree path, as loaded from an :class:`LtreeField`.
+
+    This behaves like the list of labels it was before, supporting indexing,
+    slicing, concatenation with lists, and comparison with lists, but keeps the
+    dotted string it was loaded from and only splits it into labels when it has to.
+    """
+
+    __slots__ = ("_raw", "_labels")
+
+    def __init__(self, value=""):
+        if isinstance(value, TreePath):
+            self._raw, self._labels = value._raw, value._labels
+        elif isinstance(value, str):
+            self._raw, self._labels = value, None
+        else:
+            self._labels = tuple(value)
+            self._raw = ".".join(self._labels)
+
+    @property
+    def labels(self):
+        if self._labels is None:
+            self._labels = tuple(self._raw.split(".")) if self._raw else ()
+        return self._labels
+
+    @property
+    def depth(self):
+        return len(self)
+
+    @property
+    def parent_path(self):
+        return TreePath(self._raw.rpartition(".")[0])
+
+    @property
+    def label(self):
+        return self._raw.rpartition(".")[2]
+
+    @property
+    def label_int(self):
+        """
+        The value of the last label, if it's in the default decimal codec; use
+        :meth:`label_value` for paths in any other.
+        """
+        return int(self.label)
+
+    def label_value(self, codec="decimal"):
+        """The value of the last label, decoded with the named label codec."""
+        return get_codec(codec).decode(self.label)
+
+    def startswith(self, prefix):
+        """Whether this path is prefix, or one of its descendants."""
+        prefix = str(TreePath(prefix))
+        return not prefix or self._raw == prefix or self._raw.startswith(prefix + ".")
+
+    def __str__(self):
+        return self._raw
+
+    def __repr__(self):
+        return "TreePath({!r})".format(self._raw)
+
+    def __reduce__(self):
+        return (TreePath, (self._raw,))
+
+    def __len__(self):
+        if self._labels is not None:
+            return len(self._labels)
+        return self._raw.count(".") + 1 if self._raw else 0
+
+    def __bool__(self):
+        return bool(self._raw)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return TreePath(self.labels[index])
+        return self.labels[index]
+
+    def __iter__(self):
+        return iter(self.labels)
+
+    def __add__(self, other):
+        if not isinstance(other, (TreePath, list, tuple)):
+            return NotImplemented
+        return TreePath(self.labels + tuple(other))
+
+    def __radd__(self, other):
+        if not isinstance(other, (list, tuple)):
+            return NotImplemented
+        return TreePath(tuple(other) + self.labels)
+
+    def __eq__(self, other):
+        if isinstance(other, TreePath):
+            return self._raw == other._raw
+        if isinstance(other, (list, tuple)):
+            return self.labels == tuple(other)
+        return NotImplemented
+
+    def __lt__(self, other):
+        # Labels compare as strings, as ltree's own ordering does
+        if isinstance(other, (TreePath, list, tuple)):
+            return self.labels < tuple(other)
+        return NotImplemented
+
+    def __hash__(self):
+        # The same as the tuple of labels it's equal to
+        return hash(self.labels)
+
 
 class LtreeField(Field):
     description = _("Dotted label path")
@@ -17,21 +132,21 @@ class LtreeField(Field):
         return "CharField"
 
     def to_python(self, value):
-        if isinstance(value, list) or value is None:
+        if isinstance(value, TreePath) or value is None:
             return value
-        if isinstance(value, str):
-            return value.split(".")
+        if isinstance(value, (str, list, tuple)):
+            return TreePath(value)
         raise ValueError("Don't know how to handle {!r}".format(value))
 
     def get_prep_value(self, value):
         if isinstance(value, str) or value is None:
             return value
+        if isinstance(value, (TreePath, LQuery, LTxtQuery)):
+            return str(value)
         return ".".join(value)
 
     def from_db_value(self, value, expression, connection):
-        if not value:
-            return []
-        return value.split(".")
+        return TreePath(value or "")
 
 
 class BinaryLookup(Lookup):
@@ -58,3 +173,60 @@ class DescendantOf(BinaryLookup):
 class MatchesLquery(BinaryLookup):
     lookup_name = "matches_lquery"
     operator = "~"
+
+
+@LtreeField.register_lookup
+class MatchesLtxtquery(BinaryLookup):
+    lookup_name = "matches_ltxtquery"
+    operator = "@"
+
+
+class ArrayLookup(BinaryLookup):
+    # Compares against a PostgreSQL array built from a list of values
+    array_type = None
+
+    def get_prep_lookup(self):
+        if hasattr(self.rhs, "resolve_expression"):
+            return self.rhs
+        return [self.lhs.output_field.get_prep_value(value) for value in self.rhs]
+
+    def process_rhs(self, compiler, connection):
+        rhs, rhs_params = super().process_rhs(compiler, connection)
+        return "{}::{}".format(rhs, self.array_type), rhs_params
+
+
+@LtreeField.register_lookup
+class MatchesAnyLquery(ArrayLookup):
+    lookup_name = "matches_any_lquery"
+    operator = "?"
+    array_type = "lquery[]"
+
+
+class AnyLookup(ArrayLookup):
+    # Applies a binary operator against each element of the array in turn, matching
+    # if any of them do; the GiST index is used via a bitmap scan per element
+    array_type = "ltree[]"
+
+    def process_rhs(self, compiler, connection):
+        rhs, rhs_params = super().process_rhs(compiler, connection)
+        return "ANY({})".format(rhs), rhs_params
+
+
+@LtreeField.register_lookup
+class AncestorOfAny(AnyLookup):
+    lookup_name = "ancestor_of_any"
+    operator = "@>"
+
+
+@LtreeField.register_lookup
+class DescendantOfAny(AnyLookup):
+    lookup_name = "descendant_of_any"
+    operator = "<@"
+
+
+@LtreeField.register_lookup
+class Depth(Transform):
+    # The number of labels in the path, so a root node is at depth 1
+    lookup_name = "depth"
+    function = "nlevel"
+    output_field = IntegerField()
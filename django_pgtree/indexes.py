@@ -0,0 +1,76 @@
+"""
+Indexes for a TreeNode's ``tree_path``, to pick and combine in its ``Meta.indexes``.
+
+Every TreeNode already has a btree index on ``tree_path``, backing its unique
+constraint, which serves equality lookups (like ``parent``), ``ORDER BY tree_path``
+and the "table" allocator's range scans. The GiST index serves the ltree operators
+(``ancestors``, ``descendants``, and the lquery matches behind ``children``,
+``siblings`` and ``roots``); a depth index serves queries that filter on
+``nlevel(tree_path)``.
+"""
+from django.contrib.postgres.indexes import GistIndex
+from django.db.models import Index
+
+
+class TreePathGistIndex(GistIndex):
+    """
+    A GiST index on ``tree_path`` with a given signature length, in bytes.
+
+    Longer signatures make the index bigger, but make it more selective on large
+    tables with many distinct labels. Needs PostgreSQL 13 or later.
+    """
+
+    def __init__(
+        self, *, siglen, fields=("tree_path",), name="tree_path_idx", **kwargs
+    ):
+        self.siglen = siglen
+        kwargs["opclasses"] = ["gist_ltree_ops(siglen={:d})".format(siglen)]
+        super().__init__(fields=list(fields), name=name, **kwargs)
+
+    def deconstruct(self):
+        path, args, kwargs = super().deconstruct()
+        del kwargs["opclasses"]
+        kwargs["siglen"] = self.siglen
+        return path, args, kwargs
+
+
+class TreePathDepthIndex(Index):
+    """
+    A btree index on ``(nlevel(tree_path), tree_path)``, for finding the nodes at a
+    given depth in tree order.
+    """
+
+    def __init__(self, *, fields=("tree_path",), name="tree_path_depth_idx"):
+        super().__init__(fields=list(fields), name=name)
+
+    def create_sql(self, model, schema_editor, using="", **kwargs):
+        column = schema_editor.quote_name(model._meta.get_field(self.fields[0]).column)
+        sql = (
+            "CREATE INDEX {concurrently}{name} ON {table} (nlevel({column}), {column})"
+        )
+        return sql.format(
+            concurrently="CONCURRENTLY " if kwargs.get("concurrently") else "",
+            name=schema_editor.quote_name(self.name),
+            table=schema_editor.quote_name(model._meta.db_table),
+            column=column,
+        )
+
+
+def tree_path_indexes(gist=True, siglen=None, depth=False, prefix="tree_path"):
+    """
+    Return the indexes to put in a TreeNode model's ``Meta.indexes``.
+
+    With no arguments, this is the single GiST index every TreeNode has by default.
+    ``gist=False`` leaves it out, for tables only ever queried by equality or in
+    tree order; ``siglen`` sets its signature length; and ``depth=True`` adds a
+    :class:`TreePathDepthIndex`. Index names start with ``prefix``, which needs to
+    be different for each TreeNode model sharing a database.
+    """
+    indexes = []
+    if gist and siglen is None:
+        indexes.append(GistIndex(fields=["tree_path"], name=prefix + "_idx"))
+    elif gist:
+        indexes.append(TreePathGistIndex(siglen=siglen, name=prefix + "_idx"))
+    if depth:
+        indexes.append(TreePathDepthIndex(name=prefix + "_depth_idx"))
+    return tuple(indexes)
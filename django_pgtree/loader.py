@@ -0,0 +1,263 @@
+"""
+Loading a whole tree from an adjacency list (rows that each name their parent), for
+migrating ``parent_id`` tables into a TreeNode model without saving node by node.
+
+Rows are streamed into a temporary staging table with ``COPY``, a batch at a time,
+so memory use stays bounded however many there are. Their paths are then worked out
+inside the database one level at a time, labelling each node's children in the
+order they were given, and the nodes are inserted with ``INSERT ... SELECT``.
+"""
+import io
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.transaction import atomic
+
+from .codecs import PAD_LENGTH, get_codec
+from .models import (
+    GAP,
+    CountedTreeNode,
+    ParentLinkedTreeNode,
+    TreeQuerySet,
+    forget_counters,
+    lock_prefix,
+)
+
+STAGING_TABLE = "djpgtree_load"
+
+# Escapes for COPY's text format, in which \N stands for NULL
+COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+def _copy_text(value):
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    return str(value).translate(COPY_ESCAPES)
+
+
+def _batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def load_tree(model, rows, fields, parent=None, using=None, batch_size=10000):
+    """
+    Insert the nodes of one or more trees, given as an adjacency list, into model.
+
+    Each of rows is a dict with a ``"key"`` identifying it, a ``"parent"`` giving
+    its parent's key (None or ``""`` for a root), and values for each of the model
+    fields named in fields. Keys only need to be unique within the load, and
+    parents can come before or after their children. Roots go after the existing
+    children of parent, or the existing root nodes without it; everything else is
+    labelled in the order it was given. Raises ValueError, and loads nothing, if
+    any node can't be reached from a root.
+
+    Returns the number of nodes loaded.
+    """
+    using = using or DEFAULT_DB_ALIAS
+    connection = connections[using]
+    quote_name = connection.ops.quote_name
+    fields = [model._meta.get_field(name) for name in fields]
+    counted = issubclass(model, CountedTreeNode)
+    linked = issubclass(model, ParentLinkedTreeNode)
+    prefix = [] if parent is None else list(parent.tree_path)
+
+    def column(name):
+        return quote_name(model._meta.get_field(name).column)
+
+    names = {
+        "staging": "pg_temp." + quote_name(STAGING_TABLE),
+        "table": quote_name(model._meta.db_table),
+        "tree_path": column("tree_path"),
+        "codec": "'{}'".format(get_codec(model.label_codec).name),
+        "gap": GAP,
+        "pad_length": PAD_LENGTH,
+        "column_types": "".join(
+            ", {} {}".format(quote_name(field.column), field.db_type(connection))
+            for field in fields
+        ),
+        "columns": "".join(", " + quote_name(field.column) for field in fields),
+        "staged_columns": "".join(
+            ", staged." + quote_name(field.column) for field in fields
+        ),
+        "extra_columns": "",
+        "extra_values": "",
+        "join": "",
+    }
+    if counted:
+        names["child_count"] = column("child_count")
+        names["descendant_count"] = column("descendant_count")
+        names["extra_columns"] += ", {child_count}, {descendant_count}".format(**names)
+        names["extra_values"] += ", staged.child_count, staged.descendant_count"
+    if linked:
+        parent_field = model._meta.get_field("parent")
+        names["extra_columns"] += ", " + quote_name(parent_field.column)
+        names["extra_values"] += ", parent." + quote_name(
+            parent_field.target_field.column
+        )
+        names["join"] = (
+            "LEFT JOIN {table} AS parent ON parent.{tree_path} = "
+            "subpath(staged.tree_path, 0, nlevel(staged.tree_path) - 1)"
+        ).format(**names)
+
+    with atomic(using=using), connection.cursor() as cursor:
+
+        def execute(sql, params=()):
+            cursor.execute(sql.format(**names), params)
+            return cursor.rowcount
+
+        if model.path_lock:
+            lock_prefix(model, using, prefix)
+
+        # ON COMMIT DROP only covers loads outside any other transaction, so make
+        # sure one left by an earlier load in the same transaction is gone too
+        execute("DROP TABLE IF EXISTS {staging}")
+        execute(
+            """
+            CREATE TEMPORARY TABLE {staging} (
+                position bigserial,
+                key text NOT NULL,
+                parent_key text,
+                depth integer,
+                tree_path ltree,
+                child_count integer NOT NULL DEFAULT 0,
+                descendant_count integer NOT NULL DEFAULT 0
+                {column_types}
+            ) ON COMMIT DROP
+            """
+        )
+
+        copy_sql = "COPY {staging} (key, parent_key{columns}) FROM STDIN".format(
+            **names
+        )
+        total = 0
+        for batch in _batches(rows, batch_size):
+            buffer = io.StringIO()
+            for row in batch:
+                parent_key = row.get("parent")
+                values = [row["key"], None if parent_key == "" else parent_key]
+                for field in fields:
+                    value = row.get(field.name, field.get_default())
+                    values.append(
+                        field.get_db_prep_save(field.to_python(value), connection)
+                    )
+                buffer.write("\t".join(_copy_text(value) for value in values) + "\n")
+            buffer.seek(0)
+            cursor.copy_expert(copy_sql, buffer)
+            total += len(batch)
+        if not total:
+            execute("DROP TABLE {staging}")
+            return 0
+
+        execute("CREATE UNIQUE INDEX ON {staging} (key)")
+        execute("CREATE INDEX ON {staging} (parent_key, position)")
+        execute("CREATE INDEX ON {staging} (depth)")
+        execute("ANALYZE {staging}")
+
+        # Label the roots after any existing siblings, then each level's children
+        # under the level above, until there's nothing left to reach.
+        start = TreeQuerySet(model, using=using)._next_label_value(prefix)
+        execute(
+            """
+            UPDATE {staging} AS node SET
+                depth = 0,
+                tree_path = %s::ltree || text2ltree(djpgtree_encode_label(
+                    %s + (numbered.n - 1) * {gap}, {codec}, {pad_length}
+                ))
+            FROM (
+                SELECT key, row_number() OVER (ORDER BY position) AS n
+                FROM {staging} WHERE parent_key IS NULL
+            ) AS numbered
+            WHERE node.key = numbered.key
+            """,
+            [".".join(prefix), start],
+        )
+        depth = 0
+        while execute(
+            """
+            UPDATE {staging} AS node SET
+                depth = %s,
+                tree_path = numbered.parent_path || text2ltree(djpgtree_encode_label(
+                    numbered.n * {gap}, {codec}, {pad_length}
+                ))
+            FROM (
+                SELECT
+                    child.key,
+                    parent.tree_path AS parent_path,
+                    row_number() OVER (
+                        PARTITION BY child.parent_key ORDER BY child.position
+                    ) AS n
+                FROM {staging} AS parent
+                JOIN {staging} AS child ON child.parent_key = parent.key
+                WHERE parent.depth = %s
+            ) AS numbered
+            WHERE node.key = numbered.key
+            """,
+            [depth + 1, depth],
+        ):
+            depth += 1
+
+        execute("SELECT key FROM {staging} WHERE depth IS NULL LIMIT 1")
+        unreachable = cursor.fetchone()
+        if unreachable is not None:
+            raise ValueError(
+                "Node {!r} can't be reached from a root; its parent is missing, "
+                "or it's part of a cycle".format(unreachable[0])
+            )
+
+        if counted:
+            # Add each level's counts into the level above, from the bottom up
+            for level in range(depth, 0, -1):
+                execute(
+                    """
+                    UPDATE {staging} AS node SET
+                        child_count = totals.child_count,
+                        descendant_count = totals.descendant_count
+                    FROM (
+                        SELECT
+                            parent_key,
+                            count(*) AS child_count,
+                            sum(descendant_count + 1) AS descendant_count
+                        FROM {staging} WHERE depth = %s GROUP BY parent_key
+                    ) AS totals
+                    WHERE node.key = totals.parent_key
+                    """,
+                    [level],
+                )
+
+        # One level at a time, so that each level can link to the one above
+        for level in range(depth + 1):
+            execute(
+                """
+                INSERT INTO {table} ({tree_path}{columns}{extra_columns})
+                SELECT staged.tree_path{staged_columns}{extra_values}
+                FROM {staging} AS staged {join}
+                WHERE staged.depth = %s
+                ORDER BY staged.tree_path
+                """,
+                [level],
+            )
+
+        forget_counters(model, using, parent_paths=[prefix])
+        if counted and prefix:
+            execute("SELECT count(*) FROM {staging} WHERE depth = 0")
+            (roots,) = cursor.fetchone()
+            execute(
+                """
+                UPDATE {table} SET
+                    {child_count} = {child_count}
+                        + CASE WHEN {tree_path} = %s::ltree THEN %s ELSE 0 END,
+                    {descendant_count} = {descendant_count} + %s
+                WHERE {tree_path} @> %s::ltree
+                """,
+                [".".join(prefix), roots, total, ".".join(prefix)],
+            )
+        execute("DROP TABLE {staging}")
+    return total
@@ -0,0 +1,121 @@
+"""
+Builders for the lquery and ltxtquery patterns that LtreeField's
+``matches_lquery``, ``matches_any_lquery`` and ``matches_ltxtquery`` lookups accept.
+
+Both kinds of pattern are immutable, and work out their text once, so one built at
+import time can be reused by every query that needs it.
+"""
+
+
+class LQuery:
+    """
+    An lquery, built up one level at a time; for example,
+    ``LQuery().path(node.tree_path).any(1, 2).label("foo", "bar", negate=True)``
+    matches paths one or two levels below ``node`` with a last label other than
+    ``foo`` or ``bar``.
+    """
+
+    __slots__ = ("_levels", "_text")
+
+    def __init__(self, *levels):
+        self._levels = levels
+        self._text = None
+
+    @classmethod
+    def children_of(cls, path):
+        """Matches the children of the node at path, or the roots if it's empty."""
+        return cls().path(path).any(1, 1)
+
+    def then(self, *levels):
+        """Add levels written out in lquery syntax."""
+        return LQuery(*self._levels, *levels)
+
+    def path(self, path):
+        """Add a level matching each label of path exactly."""
+        if isinstance(path, (list, tuple)):
+            path = ".".join(path)
+        path = str(path)
+        return self.then(path) if path else self
+
+    def label(self, *alternatives, negate=False):
+        """
+        Add a level matching any of the given labels, or any label but them with
+        negate. Each one can carry lquery's modifiers, like ``foo*`` or ``foo@``.
+        """
+        if not alternatives:
+            raise ValueError("label() needs at least one alternative")
+        level = "|".join(alternatives)
+        return self.then("!" + level if negate else level)
+
+    def any(self, min=0, max=None):  # pylint: disable=redefined-builtin
+        """Add a run of between min and max labels, or at least min without max."""
+        if max is None:
+            level = "*" if min == 0 else "*{{{:d},}}".format(min)
+        elif min == max:
+            level = "*{{{:d}}}".format(min)
+        else:
+            level = "*{{{:d},{:d}}}".format(min, max)
+        return self.then(level)
+
+    def __str__(self):
+        if self._text is None:
+            self._text = ".".join(self._levels)
+        return self._text
+
+    def __repr__(self):
+        return "LQuery({!r})".format(str(self))
+
+    def __eq__(self, other):
+        if not isinstance(other, LQuery):
+            return NotImplemented
+        return str(self) == str(other)
+
+    def __hash__(self):
+        return hash(str(self))
+
+
+class LTxtQuery:
+    """
+    An ltxtquery, matching paths that contain certain labels anywhere in them.
+    Combine them with ``&``, ``|`` and ``~``; for example,
+    ``LTxtQuery("Europe") & LTxtQuery("russia", prefix=True, ignore_case=True)``.
+    """
+
+    __slots__ = ("_text",)
+
+    def __init__(self, word, *, prefix=False, ignore_case=False, by_word=False):
+        self._text = "{}{}{}{}".format(
+            word,
+            "*" if prefix else "",
+            "@" if ignore_case else "",
+            "%" if by_word else "",
+        )
+
+    @classmethod
+    def _raw(cls, text):
+        query = cls.__new__(cls)
+        query._text = text
+        return query
+
+    def __and__(self, other):
+        return LTxtQuery._raw("({} & {})".format(self, other))
+
+    def __or__(self, other):
+        return LTxtQuery._raw("({} | {})".format(self, other))
+
+    def __invert__(self):
+        return LTxtQuery._raw("!{}".format(self))
+
+    def __str__(self):
+        return self._text
+
+    def __repr__(self):
+        return "LTxtQuery({!r})".format(self._text)
+
+    def __eq__(self, other):
+        if not isinstance(other, LTxtQuery):
+            return NotImplemented
+        return self._text == other._text
+
+    def __hash__(self):
+        return hash(self._text)
@@ -0,0 +1,142 @@
+import csv
+import json
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from ...loader import load_tree
+from ..utils import get_tree_model
+
+
+def read_csv(path):
+    with open(path, newline="") as f:
+        yield from csv.DictReader(f)
+
+
+def read_json_lines(path):
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+class Command(BaseCommand):
+    help = (
+        "Load nodes into a TreeNode model from an adjacency list, where each row "
+        "names its parent: another model, a CSV file with a header row, or a JSON "
+        "Lines file of objects."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("model", help="The TreeNode model, as app_label.ModelName")
+        parser.add_argument(
+            "source",
+            help="The model to read rows from, as app_label.ModelName, or the file "
+            "to read them from",
+        )
+        parser.add_argument(
+            "--format",
+            choices=["model", "csv", "jsonl"],
+            default="model",
+            help="What source is (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--key",
+            default="id",
+            help="The column identifying each row (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--parent",
+            default="parent_id",
+            help="The column giving the key of each row's parent, empty or null for "
+            "a root (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--field",
+            action="append",
+            dest="fields",
+            default=[],
+            metavar="FIELD[=COLUMN]",
+            help="A field of the model to load, and the column to load it from if "
+            "it's named differently; can be repeated. Defaults to all of the "
+            "model's editable fields.",
+        )
+        parser.add_argument(
+            "--under",
+            metavar="TREE_PATH",
+            help="The path of an existing node to load the roots beneath",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=10000,
+            help="How many rows to read and copy at a time (default: %(default)s)",
+        )
+        parser.add_argument("--database", default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        model = get_tree_model(options["model"])
+
+        fields = dict(field.partition("=")[::2] for field in options["fields"])
+        if not fields:
+            fields = {
+                field.name: ""
+                for field in model._meta.concrete_fields
+                if field.editable
+                and not field.primary_key
+                and field.name != "tree_path"
+            }
+        fields = {name: column or name for name, column in fields.items()}
+
+        using = options["database"]
+        parent = None
+        if options["under"]:
+            try:
+                parent = model._base_manager.using(using).get(
+                    tree_path=options["under"]
+                )
+            except model.DoesNotExist:
+                raise CommandError("There's no node at {}".format(options["under"]))
+
+        source_rows = self.read(options, list(fields.values()))
+        rows = (
+            {
+                "key": row[options["key"]],
+                "parent": row[options["parent"]],
+                **{name: row[column] for name, column in fields.items()},
+            }
+            for row in source_rows
+        )
+        try:
+            count = load_tree(
+                model,
+                rows,
+                list(fields),
+                parent=parent,
+                using=using,
+                batch_size=options["batch_size"],
+            )
+        except KeyError as e:
+            raise CommandError("{} has no column {}".format(options["source"], e))
+        except ValueError as e:
+            raise CommandError("Couldn't load {}: {}".format(options["source"], e))
+
+        if options["verbosity"] >= 1:
+            self.stdout.write("Loaded {} nodes.".format(count))
+
+    def read(self, options, columns):
+        if options["format"] == "csv":
+            return read_csv(options["source"])
+        if options["format"] == "jsonl":
+            return read_json_lines(options["source"])
+        try:
+            source = apps.get_model(options["source"])
+        except (LookupError, ValueError) as e:
+            raise CommandError(str(e))
+        return (
+            source._base_manager.using(options["database"])
+            .order_by("pk")
+            .values(options["key"], options["parent"], *columns)
+            .iterator(chunk_size=options["batch_size"])
+        )
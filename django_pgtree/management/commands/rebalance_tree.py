@@ -0,0 +1,96 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from ...codecs import get_codec
+from ...models import GAP, TreeQuerySet
+from ..utils import get_tree_model
+
+# For each parent, the smallest amount of room left around any of its children's
+# labels; that is, the smallest gap between consecutive siblings, or below the
+# first one.
+PACKED_PARENTS_SQL = """
+    WITH labels AS (
+        SELECT
+            CASE WHEN nlevel({column}) = 1 THEN ''::ltree
+                ELSE subpath({column}, 0, nlevel({column}) - 1)
+            END AS parent_path,
+            {column} AS tree_path,
+            {label} AS label
+        FROM {table}
+    )
+    SELECT parent_path::text, min(gap) FROM (
+        SELECT
+            parent_path,
+            label - lag(label, 1, 0::bigint) OVER (
+                PARTITION BY parent_path ORDER BY tree_path
+            ) AS gap
+        FROM labels
+    ) AS gaps
+    GROUP BY parent_path
+    HAVING min(gap) < %s
+    ORDER BY min(gap), parent_path
+    LIMIT %s
+"""
+
+
+class Command(BaseCommand):
+    help = (
+        "Renumber the children of the most tightly packed parents in a tree, so that "
+        "relocate() has room to work with again."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("model", help="The TreeNode model, as app_label.ModelName")
+        parser.add_argument(
+            "--min-gap",
+            type=int,
+            default=GAP // 2**10,
+            help="Rebalance parents with less room than this between any two "
+            "children (default: %(default)s, about ten relocations' worth)",
+        )
+        parser.add_argument(
+            "--limit",
+            type=int,
+            help="Only rebalance this many of the most tightly packed parents",
+        )
+        parser.add_argument("--database", default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        model = get_tree_model(options["model"])
+
+        if options["min_gap"] > GAP:
+            # Freshly renumbered children are GAP apart, so they'd never qualify
+            raise CommandError("--min-gap can't be more than {}".format(GAP))
+
+        using = options["database"]
+        connection = connections[using]
+        column = connection.ops.quote_name(model._meta.get_field("tree_path").column)
+        sql = PACKED_PARENTS_SQL.format(
+            table=connection.ops.quote_name(model._meta.db_table),
+            column=column,
+            label=get_codec(model.label_codec).sql_decode(
+                "subpath({}, -1)::text".format(column)
+            ),
+        )
+        # Find them all in one pass over the table, up front. Renumbering a parent
+        # moves the subtrees beneath it, so work from the deepest parents up, which
+        # leaves the paths of the ones still to come where they were.
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [options["min_gap"], options["limit"]])
+            parents = [
+                (parent_path.split(".") if parent_path else [], min_gap)
+                for parent_path, min_gap in cursor.fetchall()
+            ]
+        parents.sort(key=lambda parent: -len(parent[0]))
+
+        for path, min_gap in parents:
+            moves = TreeQuerySet(model, using=using).rebalance(path)
+            if options["verbosity"] >= 2:
+                self.stdout.write(
+                    "Rebalanced {} children of {!r} (smallest gap was {})".format(
+                        len(moves), ".".join(path), min_gap
+                    )
+                )
+
+        if options["verbosity"] >= 1:
+            self.stdout.write("Rebalanced {} parents.".format(len(parents)))
@@ -0,0 +1,88 @@
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.transaction import atomic
+
+from ...models import CountedTreeNode
+from ..utils import get_tree_model
+
+# Recount the children and descendants of the next batch of nodes in tree order,
+# returning the last path in the batch to carry on from
+RECOUNT_SQL = """
+    WITH batch AS (
+        SELECT {column} AS tree_path FROM {table}
+        WHERE {column} > %s::ltree
+        ORDER BY {column}
+        LIMIT %s
+    ), updated AS (
+        UPDATE {table} AS node SET
+            {child_count} = (
+                SELECT count(*) FROM {table} AS child
+                WHERE child.{column} <@ node.{column}
+                    AND nlevel(child.{column}) = nlevel(node.{column}) + 1
+            ),
+            {descendant_count} = (
+                SELECT count(*) - 1 FROM {table} AS descendant
+                WHERE descendant.{column} <@ node.{column}
+            )
+        FROM batch
+        WHERE node.{column} = batch.tree_path
+        RETURNING node.{column}
+    )
+    SELECT
+        (SELECT {column}::text FROM updated ORDER BY {column} DESC LIMIT 1),
+        (SELECT count(*) FROM updated)
+"""
+
+
+class Command(BaseCommand):
+    help = (
+        "Recount the child_count and descendant_count columns of every node in a "
+        "CountedTreeNode model."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "model", help="The CountedTreeNode model, as app_label.ModelName"
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="How many nodes to recount in each transaction "
+            "(default: %(default)s)",
+        )
+        parser.add_argument("--database", default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        model = get_tree_model(options["model"], CountedTreeNode)
+
+        using = options["database"]
+        connection = connections[using]
+        quote_name = connection.ops.quote_name
+        sql = RECOUNT_SQL.format(
+            table=quote_name(model._meta.db_table),
+            column=quote_name(model._meta.get_field("tree_path").column),
+            child_count=quote_name(model._meta.get_field("child_count").column),
+            descendant_count=quote_name(
+                model._meta.get_field("descendant_count").column
+            ),
+        )
+
+        # Each batch is recounted in its own short transaction, so only its own
+        # rows are locked, and only for the one UPDATE.
+        last_path = ""
+        done = 0
+        while True:
+            with atomic(using=using), connection.cursor() as cursor:
+                cursor.execute(sql, [last_path, options["batch_size"]])
+                last_path, count = cursor.fetchone()
+            if not count:
+                break
+            done += count
+            if options["verbosity"] >= 2:
+                self.stdout.write(
+                    "Recounted {} nodes, up to {!r}".format(done, last_path)
+                )
+
+        if options["verbosity"] >= 1:
+            self.stdout.write("Recounted {} nodes.".format(done))
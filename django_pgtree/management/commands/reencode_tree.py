@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.transaction import atomic
+
+from ...codecs import CODECS
+from ...models import forget_counters
+from ...operations import ReencodeTreePaths
+from ..utils import get_tree_model
+
+
+class Command(BaseCommand):
+    help = (
+        "Rewrite every label in a tree's paths from one label codec to another, "
+        "keeping their values and order."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("model", help="The TreeNode model, as app_label.ModelName")
+        parser.add_argument(
+            "--from",
+            dest="from_codec",
+            required=True,
+            choices=sorted(CODECS),
+            help="The codec the paths are currently in",
+        )
+        parser.add_argument(
+            "--to",
+            dest="to_codec",
+            choices=sorted(CODECS),
+            help="The codec to rewrite them in (default: the model's label_codec)",
+        )
+        parser.add_argument("--database", default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        model = get_tree_model(options["model"])
+
+        from_codec = options["from_codec"]
+        to_codec = options["to_codec"] or model.label_codec
+        if from_codec == to_codec:
+            raise CommandError("Paths are already in {}".format(to_codec))
+
+        using = options["database"]
+        connection = connections[using]
+        with atomic(using=using):
+            with connection.schema_editor(atomic=False) as schema_editor:
+                sql = ReencodeTreePaths.reencode_sql(
+                    model, schema_editor, from_codec, to_codec
+                )
+            with connection.cursor() as cursor:
+                cursor.execute(sql)
+                count = cursor.rowcount
+            # The counters are keyed by parent paths that no longer exist
+            forget_counters(model, using, subtrees=[[]])
+
+        if options["verbosity"] >= 1:
+            self.stdout.write(
+                "Re-encoded {} paths from {} to {}.".format(count, from_codec, to_codec)
+            )
@@ -0,0 +1,18 @@
+from django.apps import apps
+from django.core.management.base import CommandError
+
+from ..models import TreeNode
+
+
+def get_tree_model(label, base=TreeNode):
+    """
+    Look up the model named by label, as app_label.ModelName, raising CommandError
+    unless there is one and it's a subclass of base.
+    """
+    try:
+        model = apps.get_model(label)
+    except (LookupError, ValueError) as e:
+        raise CommandError(str(e))
+    if not issubclass(model, base):
+        raise CommandError("{} isn't a {}".format(model._meta.label, base.__name__))
+    return model
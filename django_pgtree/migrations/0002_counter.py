@@ -0,0 +1,59 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("django_pgtree", "0001_initial")]
+
+    operations = [
+        migrations.RunSQL(
+            """
+            CREATE TABLE djpgtree_counter (
+                table_oid regclass NOT NULL,
+                parent_path ltree NOT NULL,
+                last_label bigint NOT NULL,
+                PRIMARY KEY (table_oid, parent_path)
+            );
+
+            CREATE OR REPLACE FUNCTION djpgtree_next_counter(
+                tbl regclass,
+                prefix ltree,
+                gap bigint,
+                pad_length int
+            ) RETURNS ltree AS $function$
+                DECLARE
+                    next_label bigint;
+                BEGIN
+                    -- Bump the counter for this parent, if we've got one
+                    UPDATE djpgtree_counter
+                    SET last_label = last_label + gap
+                    WHERE table_oid = tbl AND parent_path = prefix
+                    RETURNING last_label INTO next_label;
+
+                    IF next_label IS NULL THEN
+                        -- Otherwise, this is the first allocation under this
+                        -- parent since the counter was created or forgotten, so
+                        -- seed it by looking for the highest existing sibling
+                        next_label = subpath(
+                            djpgtree_next(tbl, prefix, gap, pad_length), -1
+                        )::text::bigint;
+                        INSERT INTO djpgtree_counter (table_oid, parent_path, last_label)
+                        VALUES (tbl, prefix, next_label)
+                        ON CONFLICT (table_oid, parent_path) DO UPDATE
+                        SET last_label = GREATEST(
+                            djpgtree_counter.last_label + gap,
+                            EXCLUDED.last_label
+                        )
+                        RETURNING last_label INTO next_label;
+                    END IF;
+
+                    RETURN prefix || LPAD(next_label::text, pad_length, '0');
+                END
+            $function$ LANGUAGE plpgsql;
+        """,
+            """
+            DROP FUNCTION djpgtree_next_counter(regclass, ltree, bigint, int);
+            DROP TABLE djpgtree_counter;
+        """,
+        )
+    ]
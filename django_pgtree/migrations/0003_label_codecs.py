@@ -0,0 +1,139 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("django_pgtree", "0002_counter")]
+
+    operations = [
+        migrations.RunSQL(
+            """
+            CREATE OR REPLACE FUNCTION djpgtree_encode_label(
+                value bigint,
+                codec text,
+                pad_length int
+            ) RETURNS text AS $function$
+                DECLARE
+                    alphabet CONSTANT text =
+                        '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz';
+                    digits text = '';
+                BEGIN
+                    IF codec = 'decimal' THEN
+                        RETURN LPAD(value::text, pad_length, '0');
+                    ELSIF codec = 'base62' THEN
+                        -- Base-62 digits, prefixed with how many of them there are
+                        LOOP
+                            digits = substr(alphabet, (value % 62)::int + 1, 1) || digits;
+                            value = value / 62;
+                            EXIT WHEN value = 0;
+                        END LOOP;
+                        RETURN substr(alphabet, length(digits) + 1, 1) || digits;
+                    END IF;
+                    RAISE EXCEPTION 'Unknown label codec %', codec;
+                END
+            $function$ LANGUAGE plpgsql IMMUTABLE STRICT;
+
+            CREATE OR REPLACE FUNCTION djpgtree_decode_label(
+                label text,
+                codec text
+            ) RETURNS bigint AS $function$
+                DECLARE
+                    alphabet CONSTANT text =
+                        '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz';
+                    value bigint = 0;
+                BEGIN
+                    IF codec = 'decimal' THEN
+                        RETURN label::bigint;
+                    ELSIF codec = 'base62' THEN
+                        FOR i IN 2..length(label) LOOP
+                            value = value * 62 + strpos(alphabet, substr(label, i, 1)) - 1;
+                        END LOOP;
+                        RETURN value;
+                    END IF;
+                    RAISE EXCEPTION 'Unknown label codec %', codec;
+                END
+            $function$ LANGUAGE plpgsql IMMUTABLE STRICT;
+
+            -- The same as the four-argument allocators, but for labels in any codec
+            CREATE OR REPLACE FUNCTION djpgtree_next(
+                tbl regclass,
+                prefix ltree,
+                gap bigint,
+                pad_length int,
+                codec text
+            ) RETURNS ltree AS $function$
+                DECLARE
+                    sibling_query lquery;
+                    previous_highest ltree;
+                BEGIN
+                    IF prefix = ''::ltree THEN
+                        sibling_query = '*{1}';
+                    ELSE
+                        sibling_query = prefix::text || '.*{1}';
+                    END IF;
+
+                    EXECUTE format($$
+                        SELECT tree_path
+                        FROM %s
+                        WHERE tree_path ~ %L
+                        ORDER BY tree_path DESC LIMIT 1
+                    $$, tbl, sibling_query) INTO previous_highest;
+
+                    IF previous_highest IS NULL THEN
+                        RETURN prefix || djpgtree_encode_label(gap, codec, pad_length);
+                    ELSE
+                        RETURN prefix || djpgtree_encode_label(
+                            djpgtree_decode_label(
+                                subpath(previous_highest, -1)::text, codec
+                            ) + gap,
+                            codec,
+                            pad_length
+                        );
+                    END IF;
+                END
+            $function$ LANGUAGE plpgsql;
+
+            CREATE OR REPLACE FUNCTION djpgtree_next_counter(
+                tbl regclass,
+                prefix ltree,
+                gap bigint,
+                pad_length int,
+                codec text
+            ) RETURNS ltree AS $function$
+                DECLARE
+                    next_label bigint;
+                BEGIN
+                    UPDATE djpgtree_counter
+                    SET last_label = last_label + gap
+                    WHERE table_oid = tbl AND parent_path = prefix
+                    RETURNING last_label INTO next_label;
+
+                    IF next_label IS NULL THEN
+                        next_label = djpgtree_decode_label(
+                            subpath(
+                                djpgtree_next(tbl, prefix, gap, pad_length, codec), -1
+                            )::text,
+                            codec
+                        );
+                        INSERT INTO djpgtree_counter (table_oid, parent_path, last_label)
+                        VALUES (tbl, prefix, next_label)
+                        ON CONFLICT (table_oid, parent_path) DO UPDATE
+                        SET last_label = GREATEST(
+                            djpgtree_counter.last_label + gap,
+                            EXCLUDED.last_label
+                        )
+                        RETURNING last_label INTO next_label;
+                    END IF;
+
+                    RETURN prefix || djpgtree_encode_label(next_label, codec, pad_length);
+                END
+            $function$ LANGUAGE plpgsql;
+        """,
+            """
+            DROP FUNCTION djpgtree_next_counter(regclass, ltree, bigint, int, text);
+            DROP FUNCTION djpgtree_next(regclass, ltree, bigint, int, text);
+            DROP FUNCTION djpgtree_decode_label(text, text);
+            DROP FUNCTION djpgtree_encode_label(bigint, text, int);
+        """,
+        )
+    ]
@@ -1,15 +1,27 @@
+import itertools
 import logging
 
-from django.contrib.postgres.indexes import GistIndex
-from django.db import models
+from django.db import IntegrityError, connections, models, router
+from django.db.models.deletion import ProtectedError, get_candidate_relations_to_delete
+from django.db.models.fields.related_descriptors import ForwardManyToOneDescriptor
+from django.db.models.query import ModelIterable
+from django.db.models.sql import InsertQuery, UpdateQuery
 from django.db.transaction import atomic
 
-from .fields import LtreeField
+from .codecs import PAD_LENGTH, get_codec
+from .fields import LtreeField, TreePath
+from .indexes import tree_path_indexes
+from .lquery import LQuery
+from .operations import NEXT_LABEL, allocator_function_name
+from .signals import post_subtree_delete, pre_subtree_delete, tree_path_contention
 
 GAP = 10 ** 9
-PAD_LENGTH = 18
+# The SQLSTATE of a unique constraint violation
+UNIQUE_VIOLATION = "23505"
 logger = logging.getLogger(__name__)
 
+ROOTS = LQuery.children_of(())
+
 
 class LtreeConcat(models.Func):
     arg_joiner = "||"
@@ -24,13 +36,789 @@ class Text2Ltree(models.Func):
     function = "text2ltree"
 
 
+class Ungrouped(models.Func):
+    # Hides an aggregate from the query it's annotated on, so that the query
+    # doesn't grow a GROUP BY, and aggregates over every row it selects instead
+    contains_aggregate = False
+    template = "%(expressions)s"
+
+
 class DjPgTreeNext(models.Func):
     function = "djpgtree_next"
 
 
+class DjPgTreeNextCounter(models.Func):
+    function = "djpgtree_next_counter"
+
+
+def forget_counters(model, using, parent_paths=(), subtrees=()):
+    """
+    Drop the allocation counters kept for a model in "counter" mode.
+
+    This needs to happen whenever labels are assigned without going through the
+    counter, so that it can't fall behind them. Counters are dropped for each path in
+    parent_paths, and for each path in subtrees along with every path beneath it.
+    They'll be seeded again from the existing siblings on the next allocation.
+    """
+    if model.path_allocator != "counter" or not (parent_paths or subtrees):
+        return
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            "DELETE FROM djpgtree_counter WHERE table_oid = %s::regclass "
+            "AND (parent_path = ANY(%s::ltree[]) OR parent_path <@ ANY(%s::ltree[]))",
+            [
+                model._meta.db_table,
+                [".".join(path) for path in parent_paths],
+                [".".join(path) for path in subtrees],
+            ],
+        )
+
+
+def lock_prefix(model, using, prefix):
+    """
+    Take the advisory lock that serialises allocation under a parent's path.
+
+    The lock is held until the surrounding transaction ends. Returns True if
+    another transaction was holding it and we had to wait.
+    """
+    key = "{}:{}".format(model._meta.db_table, ".".join(prefix))
+    with connections[using].cursor() as cursor:
+        cursor.execute("SELECT pg_try_advisory_xact_lock(hashtext(%s))", [key])
+        if cursor.fetchone()[0]:
+            return False
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", [key])
+        return True
+
+
+def _is_tree_path_collision(model, using, error):
+    # Whether an IntegrityError is a unique violation on tree_path, which another
+    # attempt at allocating a label might get past, rather than anything else
+    cause = error.__cause__
+    if getattr(cause, "pgcode", None) != UNIQUE_VIOLATION:
+        return False
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(
+            cursor, model._meta.db_table
+        )
+    constraint = constraints.get(cause.diag.constraint_name)
+    return constraint is not None and constraint["columns"] == [
+        model._meta.get_field("tree_path").column
+    ]
+
+
+def update_subtree_counts(model, using, moves):
+    """
+    Bring the child_count and descendant_count columns of a CountedTreeNode model up
+    to date after subtrees have been added, moved or removed, in one UPDATE.
+
+    Each of moves is an ``(old_path, new_path, size)`` tuple for one subtree, giving
+    where its root was (None if it's new), where it is now (None if it's gone), and
+    how many nodes it has, including its root. Only the ancestors of those paths
+    are touched. This does nothing for other models.
+    """
+    if not issubclass(model, CountedTreeNode):
+        return
+    deltas = {}
+    for old_path, new_path, size in moves:
+        for path, sign in ((old_path, -1), (new_path, 1)):
+            path = tuple(path or ())
+            for depth in range(1, len(path)):
+                child_delta, descendant_delta = deltas.get(path[:depth], (0, 0))
+                if depth == len(path) - 1:
+                    child_delta += sign
+                deltas[path[:depth]] = (child_delta, descendant_delta + sign * size)
+    # Sorted, so that concurrent updates lock the same rows in the same order
+    deltas = sorted((path, delta) for path, delta in deltas.items() if any(delta))
+    if not deltas:
+        return
+    connection = connections[using]
+    quote_name = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            UPDATE {table} SET
+                {child_count} = {child_count} + deltas.child_delta,
+                {descendant_count} = {descendant_count} + deltas.descendant_delta
+            FROM (VALUES {values}) AS deltas (path, child_delta, descendant_delta)
+            WHERE {column} = deltas.path
+            """.format(
+                table=quote_name(model._meta.db_table),
+                column=quote_name(model._meta.get_field("tree_path").column),
+                child_count=quote_name(model._meta.get_field("child_count").column),
+                descendant_count=quote_name(
+                    model._meta.get_field("descendant_count").column
+                ),
+                values=", ".join(
+                    ["(%s::ltree, %s::integer, %s::integer)"] * len(deltas)
+                ),
+            ),
+            [value for path, delta in deltas for value in (".".join(path), *delta)],
+        )
+
+
+def _rewrite_subtrees(model, using, moves):
+    # Move each subtree from its old root path to its new one, rewriting the
+    # prefix of every path within it, all in a single UPDATE. Returns the number
+    # of nodes in each subtree, keyed by its new path.
+    if not moves:
+        return {}
+    connection = connections[using]
+    column = connection.ops.quote_name(model._meta.get_field("tree_path").column)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            WITH moved AS (
+                UPDATE {table} SET {column} = CASE
+                    WHEN {column} = moves.old_path THEN moves.new_path
+                    ELSE moves.new_path || subpath({column}, nlevel(moves.old_path))
+                END
+                FROM (VALUES {values}) AS moves (old_path, new_path)
+                WHERE {column} <@ moves.old_path
+                RETURNING moves.new_path
+            )
+            SELECT new_path::text, count(*) FROM moved GROUP BY new_path
+            """.format(
+                table=connection.ops.quote_name(model._meta.db_table),
+                column=column,
+                values=", ".join(["(%s::ltree, %s::ltree)"] * len(moves)),
+            ),
+            [".".join(path) for move in moves for path in move],
+        )
+        return {tuple(path.split(".")): size for path, size in cursor.fetchall()}
+
+
+def _subtree_sizes(model, using, roots, delete=False):
+    # Count the nodes in each of the subtrees at roots, which mustn't overlap,
+    # deleting them as well if asked to. Returns the counts keyed by root path.
+    connection = connections[using]
+    column = connection.ops.quote_name(model._meta.get_field("tree_path").column)
+    if delete:
+        subtrees = (
+            "DELETE FROM {table} WHERE {column} <@ ANY(%s::ltree[]) RETURNING {column}"
+        )
+    else:
+        subtrees = "SELECT {column} FROM {table} WHERE {column} <@ ANY(%s::ltree[])"
+    sql = """
+        WITH subtrees AS ({subtrees})
+        SELECT roots.root::text, count(*)
+        FROM subtrees JOIN unnest(%s::ltree[]) AS roots (root)
+            ON subtrees.{column} <@ roots.root
+        GROUP BY roots.root
+    """.format(
+        subtrees=subtrees.format(
+            table=connection.ops.quote_name(model._meta.db_table), column=column
+        ),
+        column=column,
+    )
+    roots = [".".join(root) for root in roots]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [roots, roots])
+        return {tuple(path.split(".")): size for path, size in cursor.fetchall()}
+
+
+def _deleted_from_python(model):
+    # Whether deleting rows of model needs Django's collector, to deal with rows
+    # elsewhere that refer to them, or with parent rows of its own
+    return (
+        bool(model._meta.parents)
+        or bool(model._meta.many_to_many)
+        or any(
+            rel.related_model is not model and rel.on_delete is not models.DO_NOTHING
+            for rel in get_candidate_relations_to_delete(model._meta)
+        )
+    )
+
+
+def _renumber_children(model, using, parent_path, child_paths):
+    # Give the children at child_paths evenly spaced labels in the order given,
+    # returning (old_path, new_path) pairs. The new labels all share a remainder
+    # modulo GAP that none of the old ones have, so no row's new path can clash
+    # with another's old one part way through the UPDATE.
+    parent_path = list(parent_path)
+    codec = get_codec(model.label_codec)
+    taken = {codec.decode(path[-1]) % GAP for path in child_paths}
+    offset = next(i for i in itertools.count() if i not in taken)
+    moves = [
+        (list(path), parent_path + [codec.encode(GAP * (i + 1) + offset)])
+        for i, path in enumerate(child_paths)
+    ]
+    _rewrite_subtrees(model, using, moves)
+    forget_counters(
+        model,
+        using,
+        parent_paths=[parent_path],
+        subtrees=[path for move in moves for path in move],
+    )
+    return moves
+
+
+def common_ancestor_path(nodes):
+    """
+    Return the longest tree path shared by all the given nodes, without querying.
+
+    If one of the nodes is an ancestor of all the others, this is that node's own
+    path. Returns an empty TreePath if the nodes don't share a root.
+    """
+    paths = [TreePath(node.tree_path) for node in nodes]
+    if not paths:
+        raise ValueError("common_ancestor_path() needs at least one node")
+    # Whatever the lowest and highest paths have in common, everything sorted
+    # between them has in common too
+    lowest, highest = min(paths), max(paths)
+    length = 0
+    for a, b in zip(lowest, highest):
+        if a != b:
+            break
+        length += 1
+    return lowest[:length]
+
+
+def _remap_path(path, moves):
+    # Where a path now lives, given subtree moves from _renumber_children()
+    for old_path, new_path in moves:
+        if list(path[: len(old_path)]) == old_path:
+            return new_path + list(path[len(old_path) :])
+    return path
+
+
+def _tree_events(nodes):
+    # Turn nodes in tree order into ("enter", node) and ("leave", node) pairs,
+    # keeping only the nodes above the current one in memory
+    open_nodes = []
+    for node in nodes:
+        while open_nodes and not node.tree_path.startswith(open_nodes[-1].tree_path):
+            yield "leave", open_nodes.pop()
+        yield "enter", node
+        open_nodes.append(node)
+    while open_nodes:
+        yield "leave", open_nodes.pop()
+
+
 class TreeQuerySet(models.QuerySet):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._tree_prefetches = ()
+        self._tree_prefetch_done = False
+
+    def _clone(self, *args, **kwargs):
+        clone = super()._clone(*args, **kwargs)
+        clone._tree_prefetches = self._tree_prefetches
+        return clone
+
+    def _fetch_all(self):
+        super()._fetch_all()
+        if (
+            self._tree_prefetches
+            and not self._tree_prefetch_done
+            and issubclass(self._iterable_class, ModelIterable)
+        ):
+            for kind, *args in self._tree_prefetches:
+                getattr(self, "_prefetch_tree_{}".format(kind))(
+                    self._result_cache, *args
+                )
+            self._tree_prefetch_done = True
+
     def roots(self):
-        return self.filter(tree_path__matches_lquery=["*{1}"])
+        if issubclass(self.model, ParentLinkedTreeNode):
+            return self.filter(parent=None)
+        return self.filter(tree_path__matches_lquery=ROOTS)
+
+    def annotate_subtree(self, include_self=False, **aggregates):
+        """
+        Annotate each node with aggregates over its descendants, and itself too if
+        include_self is set; for example, ``annotate_subtree(total=Sum("price"))``.
+
+        Each aggregate is a correlated subquery, matched against the GiST index on
+        tree_path, so the nodes and their aggregates come back in one query.
+        Aggregates over nodes with no descendants are NULL, except for counts,
+        which are 0.
+        """
+        subtree = (
+            self.model._base_manager.using(self.db)
+            .filter(tree_path__descendant_of=models.OuterRef("tree_path"))
+            .order_by()
+        )
+        if not include_self:
+            subtree = subtree.exclude(tree_path=models.OuterRef("tree_path"))
+        return self.annotate(
+            **{
+                name: models.Subquery(
+                    subtree.annotate(value=Ungrouped(aggregate)).values("value")
+                )
+                for name, aggregate in aggregates.items()
+            }
+        )
+
+    def with_descendant_count(self, name="num_descendants"):
+        """
+        Annotate each node with its number of descendants, as ``name``; the default
+        doesn't clash with CountedTreeNode's own ``descendant_count`` field.
+        """
+        return self.annotate_subtree(**{name: models.Count("*")})
+
+    def at_depth(self, depth):
+        """The nodes at the given depth, where root nodes are at depth 1."""
+        return self.filter(tree_path__depth=depth)
+
+    def prefetch_ancestors(self):
+        """
+        When this queryset is evaluated, fetch the ancestors of every node in it
+        with one extra query, so that ``ancestors`` and ``parent`` on the fetched
+        nodes don't need queries of their own. Nodes that share an ancestor share
+        the same instance of it.
+        """
+        clone = self._chain()
+        clone._tree_prefetches = (*self._tree_prefetches, ("ancestors",))
+        return clone
+
+    def prefetch_children(self, depth=1):
+        """
+        When this queryset is evaluated, fetch the descendants of every node in it,
+        down to the given depth, with one extra query, so that ``children`` on the
+        fetched nodes (and on their descendants, down to depth - 1 levels beneath
+        them) doesn't need queries of its own.
+        """
+        if depth < 1:
+            raise ValueError("depth must be at least 1")
+        clone = self._chain()
+        clone._tree_prefetches = (*self._tree_prefetches, ("children", depth))
+        return clone
+
+    def _prefetch_tree_children(self, nodes, depth):
+        if not nodes:
+            return
+        descendants = self.model._default_manager.using(self.db).filter(
+            tree_path__matches_any_lquery=[
+                LQuery().path(node.tree_path).any(1, depth) for node in nodes
+            ]
+        )
+        by_path = {tuple(node.tree_path): node for node in nodes}
+        for descendant in descendants:
+            by_path.setdefault(tuple(descendant.tree_path), descendant)
+
+        # We know all of a node's children if it's fewer than depth levels
+        # beneath one of the nodes we were asked about.
+        complete = set()
+        selected = {tuple(node.tree_path) for node in nodes}
+        for path in by_path:
+            for i in range(max(1, len(path) - depth + 1), len(path) + 1):
+                if path[:i] in selected:
+                    complete.add(path)
+                    break
+
+        children = {path: [] for path in complete}
+        for path in sorted(by_path):
+            if path[:-1] in children:
+                children[path[:-1]].append(by_path[path])
+        for path, node in by_path.items():
+            if node._tree_cache is None:
+                node._tree_cache = {}
+            if path in children:
+                node._tree_cache["children"] = children[path]
+            if path[:-1] in by_path:
+                node._tree_cache["parent"] = by_path[path[:-1]]
+
+    def _prefetch_tree_ancestors(self, nodes):
+        paths = {
+            tuple(node.tree_path[:i])
+            for node in nodes
+            for i in range(1, len(node.tree_path))
+        }
+        if not paths:
+            ancestors = {}
+        else:
+            ancestors = {
+                tuple(ancestor.tree_path): ancestor
+                for ancestor in self.model._default_manager.using(self.db).filter(
+                    tree_path__in=[list(path) for path in paths]
+                )
+            }
+
+        for node in [*nodes, *ancestors.values()]:
+            if node._tree_cache is None:
+                node._tree_cache = {}
+            prefixes = [
+                tuple(node.tree_path[:i]) for i in range(1, len(node.tree_path))
+            ]
+            node._tree_cache["ancestors"] = [
+                ancestors[prefix] for prefix in prefixes if prefix in ancestors
+            ]
+            if not prefixes:
+                node._tree_cache["parent"] = None
+            elif prefixes[-1] in ancestors:
+                node._tree_cache["parent"] = ancestors[prefixes[-1]]
+
+    def bulk_create_tree(self, objs, batch_size=None):
+        """
+        Insert a batch of unsaved nodes, assigning all of their tree paths up front.
+
+        Each node's parent may be an already-saved node, or another node earlier or
+        later in the same batch. Siblings are labelled in the order they appear in
+        ``objs``, after any siblings that already exist, exactly as if each node had
+        been saved individually; this takes one query per distinct saved parent plus
+        the inserts themselves.
+        """
+        self._for_write = True
+        objs = list(objs)
+        in_batch = {id(obj): obj for obj in objs}
+
+        # Group nodes under their parents, keeping the order they were given in.
+        # Parents outside the batch are keyed by their tree path, and parents inside
+        # it by their identity, since they don't have a tree path yet.
+        parent_keys = {}
+        groups = {}
+        for obj in objs:
+            parent = obj.parent
+            if parent is None:
+                key = ()
+            elif id(parent) in in_batch:
+                key = id(parent)
+            elif not parent.tree_path:
+                raise ValueError("Parent node must be saved before receiving children")
+            else:
+                key = tuple(parent.tree_path)
+            parent_keys[id(obj)] = key
+            groups.setdefault(key, []).append(obj)
+
+        with atomic(using=self.db):
+            if self.model.path_lock:
+                # Sorted, so that concurrent batches take the locks in the same order
+                for key in sorted(key for key in groups if isinstance(key, tuple)):
+                    lock_prefix(self.model, self.db, key)
+
+            codec = get_codec(self.model.label_codec)
+            labels = {}
+            for key, children in groups.items():
+                start = self._next_label_value(key) if isinstance(key, tuple) else GAP
+                for i, obj in enumerate(children):
+                    labels[id(obj)] = codec.encode(start + i * GAP)
+
+            paths = {}
+            for obj in objs:
+                # Walk up through any unresolved parents in the batch, then resolve
+                # the chain from the top down.
+                chain = []
+                current = obj
+                while id(current) not in paths:
+                    chain.append(current)
+                    key = parent_keys[id(current)]
+                    if not isinstance(key, int):
+                        break
+                    current = in_batch[key]
+                    if any(node is current for node in chain):
+                        raise ValueError("Nodes in the batch form a cycle")
+                for node in reversed(chain):
+                    key = parent_keys[id(node)]
+                    prefix = paths[key] if isinstance(key, int) else list(key)
+                    paths[id(node)] = prefix + [labels[id(node)]]
+
+            # The size of each node's subtree within the batch, and its number of
+            # children there
+            sizes = dict.fromkeys(in_batch, 1)
+            child_counts = dict.fromkeys(in_batch, 0)
+            for obj in objs:
+                key = parent_keys[id(obj)]
+                if isinstance(key, int):
+                    child_counts[key] += 1
+                while isinstance(key, int):
+                    sizes[key] += 1
+                    key = parent_keys[key]
+
+            counted = issubclass(self.model, CountedTreeNode)
+            linked = issubclass(self.model, ParentLinkedTreeNode)
+            parents = {id(obj): obj.parent for obj in objs}
+            for obj in objs:
+                obj._set_tree_path(paths[id(obj)])
+                if linked and id(parents[id(obj)]) not in in_batch:
+                    # Parents in the batch are linked once they've been inserted,
+                    # since bulk_create() refuses unsaved related objects
+                    obj._link_parent(parents[id(obj)])
+                if counted:
+                    obj.child_count = child_counts[id(obj)]
+                    obj.descendant_count = sizes[id(obj)] - 1
+            forget_counters(
+                self.model,
+                self.db,
+                parent_paths=[
+                    paths[key] if isinstance(key, int) else key for key in groups
+                ],
+            )
+            created = self.bulk_create(objs, batch_size=batch_size)
+            if linked:
+                # Parents in the batch only got their primary keys just now
+                children = [obj for obj in objs if id(parents[id(obj)]) in in_batch]
+                for obj in children:
+                    obj._link_parent(parents[id(obj)])
+                self.bulk_update(children, ["parent"], batch_size=batch_size)
+            update_subtree_counts(
+                self.model,
+                self.db,
+                [
+                    (None, paths[id(obj)], sizes[id(obj)])
+                    for obj in objs
+                    if not isinstance(parent_keys[id(obj)], int)
+                ],
+            )
+            return created
+
+    def as_tree(self):
+        """
+        Fetch the selected nodes in one query, and link them to each other in
+        memory, returning the ones whose parents weren't selected.
+
+        On the returned nodes and everything beneath them, ``parent``,
+        ``children``, ``ancestors`` and ``siblings`` are answered from the fetched
+        nodes where possible, without any further queries, and return lists
+        rather than querysets. Only nodes that were selected are included, so
+        filtering out a node hides it from its relatives too.
+        """
+        nodes = list(self.order_by("tree_path"))
+        by_path = {tuple(node.tree_path): node for node in nodes}
+        for node in nodes:
+            node._tree_cache = {"children": []}
+
+        top_level = []
+        for node in nodes:
+            parent = by_path.get(tuple(node.tree_path[:-1]))
+            if parent is not None:
+                node._tree_cache["parent"] = parent
+                parent._tree_cache["children"].append(node)
+            else:
+                if len(node.tree_path) == 1:
+                    node._tree_cache["parent"] = None
+                top_level.append(node)
+
+        roots = [node for node in top_level if len(node.tree_path) == 1]
+        for root in roots:
+            root._tree_cache["siblings"] = [x for x in roots if x is not root]
+        return top_level
+
+    def iter_tree(self, chunk_size=2000, nested=False):
+        """
+        Stream the selected nodes in tree order through a server-side cursor,
+        fetching chunk_size rows at a time, without caching them.
+
+        With nested, yield ``("enter", node)`` when each node is reached and
+        ``("leave", node)`` once everything beneath it has been, so that nested
+        output can be written out as it goes. Nodes whose parents weren't selected
+        are nested beneath their closest selected ancestor.
+        """
+        nodes = self.order_by("tree_path").iterator(chunk_size=chunk_size)
+        return _tree_events(nodes) if nested else nodes
+
+    def keyset_paginate(self, page_size, after_path=None):
+        """
+        Return a page of up to page_size of the selected nodes in tree order,
+        starting after the node at after_path, or from the beginning without it.
+
+        Pass the last node's ``tree_path`` to get the next page. Unlike slicing
+        with an offset, each page is found with the ``tree_path`` index, so later
+        pages are as fast as the first.
+        """
+        queryset = self.order_by("tree_path")
+        if after_path is not None:
+            queryset = queryset.filter(tree_path__gt=after_path)
+        return queryset[:page_size]
+
+    def move_to(self, new_parent):
+        """
+        Move every selected node, along with its subtree, to the end of new_parent's
+        children, or to the end of the root nodes if new_parent is None.
+
+        The moved nodes keep their relative order, and get consecutive labels after
+        any existing children. Selected nodes beneath other selected nodes move
+        along with their ancestor rather than separately. Everything happens in one
+        UPDATE. Returns the number of subtrees moved.
+        """
+        self._for_write = True
+        target = [] if new_parent is None else list(new_parent.tree_path)
+
+        with atomic(using=self.db):
+            if self.model.path_lock:
+                lock_prefix(self.model, self.db, target)
+
+            roots = self.__subtree_roots()
+            if any(target[: len(path)] == path for path in roots):
+                raise ValueError("Can't move a node to beneath itself")
+
+            codec = get_codec(self.model.label_codec)
+            start = self._next_label_value(target)
+            moves = [
+                (path, target + [codec.encode(start + i * GAP)])
+                for i, path in enumerate(roots)
+            ]
+            sizes = _rewrite_subtrees(self.model, self.db, moves)
+            if issubclass(self.model, ParentLinkedTreeNode):
+                self.model._base_manager.using(self.db).filter(
+                    tree_path__in=[new for _, new in moves]
+                ).update(parent=new_parent)
+            forget_counters(
+                self.model,
+                self.db,
+                parent_paths=[target],
+                subtrees=[path for move in moves for path in move],
+            )
+            update_subtree_counts(
+                self.model,
+                self.db,
+                [(old, new, sizes[tuple(new)]) for old, new in moves],
+            )
+        return len(moves)
+
+    # Not on the manager, where it would move every root node
+    move_to.queryset_only = True
+
+    def delete_subtrees(self, signals="batch"):
+        """
+        Delete every selected node along with its whole subtree, in one
+        ``DELETE ... WHERE tree_path <@ ANY(...)``.
+
+        With ``signals="batch"``, :data:`~django_pgtree.signals.pre_subtree_delete`
+        and :data:`~django_pgtree.signals.post_subtree_delete` are sent once, with
+        the paths of the deleted subtrees, rather than ``pre_delete`` and
+        ``post_delete`` for each row; with ``None``, nothing is sent. Both skip
+        loading the rows, so they can't be used on models that other models refer
+        to, which need ``signals="row"``: an ordinary ``QuerySet.delete()`` of the
+        subtrees, with everything that entails. Returns the same as
+        ``QuerySet.delete()``.
+        """
+        if signals not in ("batch", "row", None):
+            raise ValueError("signals must be 'batch', 'row' or None")
+        if signals != "row" and _deleted_from_python(self.model):
+            raise ValueError(
+                "{} has relations that need deleting from Python; "
+                "use signals='row'".format(self.model._meta.label)
+            )
+        self._for_write = True
+        counted = issubclass(self.model, CountedTreeNode)
+
+        with atomic(using=self.db):
+            roots = self.__subtree_roots()
+            if not roots:
+                return 0, {}
+            if signals == "row":
+                sizes = {}
+                if counted:
+                    sizes = _subtree_sizes(self.model, self.db, roots)
+                rv = (
+                    self.model._base_manager.using(self.db)
+                    .filter(tree_path__descendant_of_any=roots)
+                    .delete()
+                )
+            else:
+                if signals == "batch":
+                    pre_subtree_delete.send(
+                        sender=self.model, paths=roots, using=self.db
+                    )
+                sizes = _subtree_sizes(self.model, self.db, roots, delete=True)
+                count = sum(sizes.values())
+                rv = count, {self.model._meta.label: count}
+                if signals == "batch":
+                    post_subtree_delete.send(
+                        sender=self.model, paths=roots, using=self.db, count=count
+                    )
+            forget_counters(self.model, self.db, subtrees=roots)
+            if counted:
+                update_subtree_counts(
+                    self.model,
+                    self.db,
+                    [(root, None, sizes.get(tuple(root), 0)) for root in roots],
+                )
+        return rv
+
+    # Not on the manager, where it would delete the whole table
+    delete_subtrees.queryset_only = True
+
+    def __subtree_roots(self):
+        # The paths of the selected nodes that aren't beneath other selected nodes
+        roots = []
+        for path in self.order_by("tree_path").values_list("tree_path", flat=True):
+            path = list(path)
+            # Subtrees are contiguous in tree_path order, so anything beneath a
+            # node we've already seen comes straight after it.
+            if roots and path[: len(roots[-1])] == roots[-1]:
+                continue
+            roots.append(path)
+        return roots
+
+    def _next_label_value(self, prefix):
+        # The label value that a new child of prefix would get, by the same
+        # reckoning as djpgtree_next
+        highest = (
+            self.model._base_manager.using(self.db)
+            .filter(tree_path__matches_lquery=LQuery.children_of(prefix))
+            .order_by("-tree_path")
+            .values_list("tree_path", flat=True)
+            .first()
+        )
+        if highest:
+            return get_codec(self.model.label_codec).decode(highest[-1]) + GAP
+        return GAP
+
+    def __check_unfiltered(self, method):
+        if self.query.has_filters() or not self.query.can_filter():
+            raise ValueError(
+                "{}() works on whole sets of siblings, so can't be called on a "
+                "filtered or sliced queryset".format(method)
+            )
+
+    def rebalance(self, parent_path=()):
+        """
+        Renumber the children of the node at parent_path, or the root nodes, so that
+        their labels are evenly spaced again, moving each child's subtree with it.
+
+        This happens in one UPDATE, in its own transaction, and only locks the rows
+        being renumbered. Returns a list of ``(old_path, new_path)`` pairs for the
+        children. It always renumbers all of them, so it can't be called on a
+        filtered queryset.
+        """
+        self.__check_unfiltered("rebalance")
+        self._for_write = True
+        with atomic(using=self.db):
+            if self.model.path_lock:
+                lock_prefix(self.model, self.db, parent_path)
+            children = list(
+                self.model._base_manager.using(self.db)
+                .filter(tree_path__matches_lquery=LQuery.children_of(parent_path))
+                .order_by("tree_path")
+                .values_list("tree_path", flat=True)
+            )
+            return _renumber_children(self.model, self.db, parent_path, children)
+
+    def reorder(self, nodes):
+        """
+        Put a set of siblings into the given order, giving them fresh, evenly spaced
+        labels and moving each of their subtrees along with them in one UPDATE.
+
+        ``nodes`` must contain every child of their parent (or every root node)
+        exactly once; their ``tree_path`` attributes are updated in place. It can't
+        be called on a filtered queryset.
+        """
+        self.__check_unfiltered("reorder")
+        self._for_write = True
+        nodes = list(nodes)
+        if not nodes:
+            return
+        parent_path = list(nodes[0].tree_path[:-1])
+        given = [list(node.tree_path) for node in nodes]
+
+        with atomic(using=self.db):
+            if self.model.path_lock:
+                lock_prefix(self.model, self.db, parent_path)
+            current = (
+                self.model._base_manager.using(self.db)
+                .filter(tree_path__matches_lquery=LQuery.children_of(parent_path))
+                .values_list("tree_path", flat=True)
+            )
+            if sorted(given) != sorted(list(path) for path in current):
+                raise ValueError(
+                    "Nodes to reorder must be all of the children of one parent"
+                )
+            moves = _renumber_children(self.model, self.db, parent_path, given)
+
+        for node, (_, new_path) in zip(nodes, moves):
+            node.tree_path = TreePath(new_path)
 
 
 UNCHANGED = object()
@@ -38,13 +826,54 @@ UNCHANGED = object()
 
 class TreeNode(models.Model):
     __new_parent = UNCHANGED
+    __relocated_from = None
     tree_path = LtreeField(unique=True)
 
+    # How labels for new tree paths are allocated: "generic" uses the djpgtree_next
+    # function, which works on any table; "table" uses the function created for
+    # this model's table by the CreateTreePathAllocator migration operation; and
+    # "counter" keeps a next-label counter per parent in the djpgtree_counter table,
+    # so allocation takes the same time however many siblings there are.
+    path_allocator = "generic"
+
+    # The name of the codec that turns label values into the text of each level's
+    # label: "decimal" for zero-padded decimal digits, or "base62" for a shorter
+    # encoding that keeps the same order. See django_pgtree.codecs, and
+    # ReencodeTreePaths for converting existing rows.
+    label_codec = "decimal"
+
+    # How concurrent allocations under the same parent are kept from colliding on
+    # tree_path's unique constraint. With path_lock, saves that allocate a path
+    # take a transaction-scoped advisory lock on the parent's path first; with
+    # path_retries, a save whose write collides is retried in a savepoint up to
+    # that many times. Either way, each instance of contention is logged and sent
+    # as the tree_path_contention signal.
+    path_lock = False
+    path_retries = 0
+
+    # Whether the triggers created by the InstallTreeTriggers migration operation
+    # are installed on this model's table. If they are, saves leave allocating new
+    # labels and moving descendants to them.
+    tree_triggers = False
+
+    # What delete() does with a node's descendants: None leaves them where they
+    # are; "cascade" deletes them too; "promote" moves its children up to its
+    # parent, after their new siblings; and "protect" refuses to delete a node
+    # with children, raising ProtectedError.
+    orphan_policy = None
+
+    # Relatives fetched along with this instance, by TreeQuerySet.as_tree() and
+    # friends, so that the relationship properties can be answered without a query
+    _tree_cache = None
+
+    # The fields a move writes, which save(update_fields=...) always includes
+    _moved_fields = ("tree_path",)
+
     objects = TreeQuerySet.as_manager()
 
     class Meta:
         abstract = True
-        indexes = (GistIndex(fields=["tree_path"], name="tree_path_idx"),)
+        indexes = tree_path_indexes()
         ordering = ("tree_path",)
 
     def __init__(self, *args, parent=None, **kwargs):
@@ -56,7 +885,9 @@ class TreeNode(models.Model):
     def parent(self):
         if self.__new_parent is not UNCHANGED:
             return self.__new_parent
-        parent_path = self.tree_path[:-1]  # pylint: disable=unsubscriptable-object
+        if self._tree_cache and "parent" in self._tree_cache:
+            return self._tree_cache["parent"]
+        parent_path = TreePath(self.tree_path or "").parent_path
         if not parent_path:
             return None
         return self.__class__.objects.get(tree_path=parent_path)
@@ -68,13 +899,47 @@ class TreeNode(models.Model):
         # Replace our tree_path with a new one that has our new parent's
         self.__new_parent = new_parent
 
+    def _new_parent(self):
+        # The parent assigned since we were last saved, or UNCHANGED
+        return self.__new_parent
+
+    def reorder_children(self, children):
+        """
+        Put all of this node's children into the given order in one go.
+
+        See :meth:`TreeQuerySet.reorder`.
+        """
+        children = list(children)
+        for child in children:
+            if list(child.tree_path[:-1]) != list(self.tree_path):
+                raise ValueError("{!r} isn't a child of {!r}".format(child, self))
+        self.__class__.objects.reorder(children)
+
+    def _set_tree_path(self, tree_path):
+        # Assign a tree path that has already been worked out elsewhere, so that
+        # save() doesn't try to allocate one again under a pending parent.
+        self.tree_path = TreePath(tree_path)
+        self.__new_parent = UNCHANGED
+
     def __next_tree_path_qx(self, prefix=()):
-        return DjPgTreeNext(
-            models.Value(self._meta.db_table),
-            models.Value(".".join(prefix)),
-            GAP,
-            PAD_LENGTH,
-        )
+        if self.tree_triggers:
+            # A placeholder, which the trigger replaces with a real label
+            return models.Value(".".join([*prefix, NEXT_LABEL]))
+        if self.path_allocator == "table":
+            # The table's own function has its codec built in
+            return models.Func(
+                models.Value(".".join(prefix)),
+                GAP,
+                PAD_LENGTH,
+                function=allocator_function_name(self._meta.db_table),
+            )
+        args = [models.Value(self._meta.db_table), models.Value(".".join(prefix))]
+        args += [GAP, PAD_LENGTH]
+        if self.label_codec != "decimal":
+            args.append(models.Value(self.label_codec))
+        if self.path_allocator == "counter":
+            return DjPgTreeNextCounter(*args)
+        return DjPgTreeNext(*args)
 
     def relocate(self, *, after=None, before=None):
         if after is None and before is None:
@@ -111,65 +976,269 @@ class TreeNode(models.Model):
         ):
             raise ValueError("Before and after nodes aren't actually siblings")
 
-        next_v = int(new_next_child.tree_path[-1])
+        # Remember where we were, so that save() can bring our descendants along
+        if self.__relocated_from is None and self.tree_path:
+            self.__relocated_from = list(self.tree_path)
+
+        codec = get_codec(self.label_codec)
+        next_v = codec.decode(new_next_child.tree_path[-1])
+        lower_v = (
+            -1 if new_prev_child is None else codec.decode(new_prev_child.tree_path[-1])
+        )
+        if next_v - lower_v < 2:
+            # There's no room left between our new neighbours, so spread their
+            # siblings out again, and find where everything ended up.
+            moves = self.__class__.objects.rebalance(new_next_child.tree_path[:-1])
+            for node in (self, new_prev_child, new_next_child):
+                if node is not None and node.tree_path:
+                    node.tree_path = TreePath(_remap_path(node.tree_path, moves))
+            if self.__relocated_from is not None:
+                self.__relocated_from = _remap_path(self.__relocated_from, moves)
+            next_v = codec.decode(new_next_child.tree_path[-1])
+
         if new_prev_child is None:
-            self.tree_path = new_next_child.tree_path[:-1] + [
-                str(next_v // 2).zfill(PAD_LENGTH)
-            ]
+            tree_path = new_next_child.tree_path[:-1] + [codec.encode(next_v // 2)]
         else:
-            prev_v = int(new_prev_child.tree_path[-1])
+            prev_v = codec.decode(new_prev_child.tree_path[-1])
             this_v = prev_v + (next_v - prev_v) // 2
-            self.tree_path = new_prev_child.tree_path[:-1] + [
-                str(this_v).zfill(PAD_LENGTH)
-            ]
+            tree_path = new_prev_child.tree_path[:-1] + [codec.encode(this_v)]
+        self._set_tree_path(tree_path)
 
     def save(self, *args, **kwargs):  # pylint: disable=arguments-differ
-        tree_path_needs_refresh = False
-        old_tree_path = None
+        old_tree_path = self.__relocated_from
+        new_prefix = None
 
         if self.__new_parent is None:
-            old_tree_path = self.tree_path or None
-            self.tree_path = self.__next_tree_path_qx([])
+            old_tree_path = old_tree_path or self.tree_path or None
+            new_prefix = []
         elif self.__new_parent is not UNCHANGED:
-            tree_path_needs_refresh = True
-            old_tree_path = self.tree_path or None
-            self.tree_path = self.__next_tree_path_qx(self.__new_parent.tree_path)
+            old_tree_path = old_tree_path or self.tree_path or None
+            new_prefix = self.__new_parent.tree_path
+        elif not self.tree_path:
+            new_prefix = []
 
-        if not self.tree_path:
-            tree_path_needs_refresh = True
-            self.tree_path = self.__next_tree_path_qx()
+        # A pending move always writes the new path, whichever fields were asked for
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and (
+            new_prefix is not None or old_tree_path is not None
+        ):
+            kwargs["update_fields"] = {*update_fields, *self._moved_fields}
+
+        # Whenever tree_path is an allocation expression, _do_insert() and
+        # _do_update() read the computed path back with RETURNING, so it's already
+        # up to date by the time super().save() returns.
 
         # If we haven't changed the parent, save as normal.
         if old_tree_path is None:
-            rv = super().save(*args, **kwargs)
+            if new_prefix is None:
+                rv = super().save(*args, **kwargs)
+            else:
+                rv = self.__save_with_new_path(new_prefix, *args, **kwargs)
+                update_subtree_counts(
+                    self.__class__, self._state.db, [(None, self.tree_path, 1)]
+                )
 
         # If we have, use a transaction to avoid other contexts seeing the intermediate
         # state where our descendants aren't connected to us.
         else:
             with atomic():
-                rv = super().save(*args, **kwargs)
+                if new_prefix is None:
+                    rv = super().save(*args, **kwargs)
+                else:
+                    rv = self.__save_with_new_path(new_prefix, *args, **kwargs)
                 # Move all of our descendants along with us, by substituting our old
                 # ltree prefix with our new one, in every descendant that
                 # has that prefix.
-                self.refresh_from_db(fields=("tree_path",))
-                tree_path_needs_refresh = False
-                self.__class__.objects.filter(
-                    tree_path__descendant_of=old_tree_path
-                ).update(
-                    tree_path=LtreeConcat(
-                        models.Value(".".join(self.tree_path)),
-                        Subpath(models.F("tree_path"), len(old_tree_path)),
+                moved = 0
+                if not self.tree_triggers:
+                    moved = self.__class__.objects.filter(
+                        tree_path__descendant_of=old_tree_path
+                    ).update(
+                        tree_path=LtreeConcat(
+                            models.Value(".".join(self.tree_path)),
+                            Subpath(models.F("tree_path"), len(old_tree_path)),
+                        )
                     )
+                elif issubclass(self.__class__, CountedTreeNode):
+                    # The trigger has already moved our descendants; count them
+                    # where they ended up
+                    moved = self.descendants.count()
+                # Counters under either location may now be behind the labels
+                # our subtree brought with it.
+                forget_counters(
+                    self.__class__,
+                    self._state.db,
+                    subtrees=[old_tree_path, self.tree_path],
                 )
+                update_subtree_counts(
+                    self.__class__,
+                    self._state.db,
+                    [(old_tree_path, self.tree_path, moved + 1)],
+                )
+
+        if new_prefix is not None or old_tree_path is not None:
+            self._tree_cache = None
+        self.__new_parent = UNCHANGED
+        self.__relocated_from = None
+        logger.debug(
+            "For object %s, old_tree_path is %s, tree_path is %s",
+            self,
+            old_tree_path,
+            self.tree_path,
+        )
+        return rv
+
+    def delete(self, using=None, keep_parents=False):
+        using = using or router.db_for_write(self.__class__, instance=self)
+        if self.orphan_policy == "cascade":
+            subtree = TreeQuerySet(self.__class__, using=using).filter(pk=self.pk)
+            rv = subtree.delete_subtrees(signals="row")
+            self.pk = None
+            return rv
 
-        if tree_path_needs_refresh:
-            self.refresh_from_db(fields=("tree_path",))
-        logger.debug('For object %s, old_tree_path is %s, tree_path is',
-                     self, old_tree_path, self.tree_path)
+        with atomic(using=using):
+            children = TreeQuerySet(self.__class__, using=using).filter(
+                tree_path__matches_lquery=LQuery.children_of(self.tree_path)
+            )
+            if self.orphan_policy == "protect" and children.exists():
+                raise ProtectedError(
+                    "Can't delete {!r} because it has children".format(self),
+                    list(children),
+                )
+            if self.orphan_policy == "promote":
+                children.move_to(self.parent)
+            tree_path = self.tree_path
+            rv = super().delete(using=using, keep_parents=keep_parents)
+            update_subtree_counts(self.__class__, using, [(tree_path, None, 1)])
         return rv
 
+    def delete_subtree(self, signals="batch"):
+        """
+        Delete this node and all of its descendants in one statement.
+
+        See :meth:`TreeQuerySet.delete_subtrees`.
+        """
+        return (
+            TreeQuerySet(self.__class__, using=self._state.db)
+            .filter(pk=self.pk)
+            .delete_subtrees(signals=signals)
+        )
+
+    def __save_with_new_path(self, prefix, *args, **kwargs):
+        # Save, allocating a new tree path under the given prefix. Two transactions
+        # allocating under the same parent at once will both pick the same label, so
+        # depending on configuration we either serialise them with an advisory lock,
+        # or retry in a savepoint when the loser's write fails.
+        if not (self.path_lock or self.path_retries):
+            self.tree_path = self.__next_tree_path_qx(prefix)
+            return super().save(*args, **kwargs)
+
+        using = kwargs.get("using") or router.db_for_write(
+            self.__class__, instance=self
+        )
+        attempt = 0
+        while True:
+            attempt += 1
+            self.tree_path = self.__next_tree_path_qx(prefix)
+            try:
+                with atomic(using=using):
+                    if self.path_lock and lock_prefix(self.__class__, using, prefix):
+                        self.__contention("lock", prefix, 1)
+                    return super().save(*args, **kwargs)
+            except IntegrityError as e:
+                if attempt > self.path_retries or not _is_tree_path_collision(
+                    self.__class__, using, e
+                ):
+                    raise
+                self.__contention("retry", prefix, attempt)
+
+    def __contention(self, kind, prefix, attempt):
+        logger.info(
+            "Contention (%s, attempt %d) allocating a tree path under %r in %s",
+            kind,
+            attempt,
+            ".".join(prefix),
+            self._meta.label,
+        )
+        tree_path_contention.send(
+            sender=self.__class__,
+            instance=self,
+            kind=kind,
+            parent_path=list(prefix),
+            attempt=attempt,
+        )
+
+    def _do_insert(self, manager, using, fields, returning_fields, raw):
+        if not hasattr(self.tree_path, "resolve_expression"):
+            return super()._do_insert(manager, using, fields, returning_fields, raw)
+
+        # Django 2.x passes a flag asking for the primary key; later versions pass
+        # the list of fields whose values should be returned.
+        legacy = not isinstance(returning_fields, (list, tuple))
+        columns = [self._meta.pk] if legacy else list(returning_fields)
+
+        query = InsertQuery(manager.model)
+        query.insert_values(fields, [self], raw=raw)
+        sql, params = query.get_compiler(using=using).as_sql()[0]
+        row = self.__execute_returning_tree_path(using, sql, params, columns)
+        if legacy:
+            return row[0]
+        return [row]
+
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, forced_update):
+        if not hasattr(self.tree_path, "resolve_expression") or not any(
+            field.attname == "tree_path" for field, _, _ in values
+        ):
+            return super()._do_update(
+                base_qs, using, pk_val, values, update_fields, forced_update
+            )
+
+        filtered = base_qs.filter(pk=pk_val)
+        # As in Django, select_on_save makes sure the row is there before updating
+        if self._meta.select_on_save and not forced_update and not filtered.exists():
+            return False
+        query = filtered.query.chain(UpdateQuery)
+        query.add_update_fields(values)
+        query.annotations = {}
+        sql, params = query.get_compiler(using=using).as_sql()
+        return self.__execute_returning_tree_path(using, sql, params) is not None
+
+    def __execute_returning_tree_path(self, using, sql, params, columns=()):
+        # Run an INSERT or UPDATE of this row, reading back the tree path the
+        # database allocated for it, along with any other columns asked for.
+        connection = connections[using]
+        field = self._meta.get_field("tree_path")
+        returning = ", ".join(
+            connection.ops.quote_name(f.column) for f in [*columns, field]
+        )
+        with connection.cursor() as cursor:
+            cursor.execute("{} RETURNING {}".format(sql, returning), params)
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        self.tree_path = field.from_db_value(row[-1], None, connection)
+        return tuple(row[:-1])
+
+    @property
+    def depth(self):
+        return TreePath(self.tree_path).depth
+
+    def is_ancestor_of(self, other):
+        other_path = TreePath(other.tree_path)
+        return other_path != self.tree_path and other_path.startswith(self.tree_path)
+
+    def is_descendant_of(self, other):
+        return other.is_ancestor_of(self)
+
+    def is_sibling_of(self, other):
+        path, other_path = TreePath(self.tree_path), TreePath(other.tree_path)
+        return path != other_path and path.parent_path == other_path.parent_path
+
     @property
     def ancestors(self):
+        cached = self.__cached_ancestors()
+        if cached is not None:
+            return cached
         return self.__class__.objects.filter(
             tree_path__ancestor_of=self.tree_path
         ).exclude(pk=self.pk)
@@ -180,10 +1249,36 @@ class TreeNode(models.Model):
             tree_path__descendant_of=self.tree_path
         ).exclude(pk=self.pk)
 
+    def iter_descendants(self, chunk_size=2000, nested=False):
+        """
+        Stream our descendants in tree order.
+
+        See :meth:`TreeQuerySet.iter_tree`.
+        """
+        return self.descendants.iter_tree(chunk_size=chunk_size, nested=nested)
+
+    def descendants_to_depth(self, depth):
+        """Our descendants at most depth levels beneath us."""
+        if depth < 1:
+            raise ValueError("depth must be at least 1")
+        return self.__class__.objects.filter(
+            tree_path__matches_lquery=LQuery().path(self.tree_path).any(1, depth)
+        )
+
+    def descendants_at_depth(self, depth):
+        """Our descendants exactly depth levels beneath us; 1 gives our children."""
+        if depth < 1:
+            raise ValueError("depth must be at least 1")
+        return self.__class__.objects.filter(
+            tree_path__matches_lquery=LQuery().path(self.tree_path).any(depth, depth)
+        )
+
     @property
     def children(self):
+        if self._tree_cache and "children" in self._tree_cache:
+            return self._tree_cache["children"]
         return self.__class__.objects.filter(
-            tree_path__matches_lquery=[*self.tree_path, "*{1}"]
+            tree_path__matches_lquery=LQuery.children_of(self.tree_path)
         )
 
     @property
@@ -195,6 +1290,163 @@ class TreeNode(models.Model):
 
     @property
     def siblings(self):
+        cache = self._tree_cache or {}
+        if "siblings" in cache:
+            return cache["siblings"]
+        parent_cache = cache.get("parent") and cache["parent"]._tree_cache
+        if parent_cache and "children" in parent_cache:
+            return [x for x in parent_cache["children"] if x is not self]
         return self.__class__.objects.filter(
-            tree_path__matches_lquery=[*self.tree_path[:-1], "*{1}"]
+            tree_path__matches_lquery=LQuery.children_of(
+                TreePath(self.tree_path).parent_path
+            )
         ).exclude(pk=self.pk)
+
+    def __cached_ancestors(self):
+        # Our ancestors, if they can all be found by following cached parents
+        cache = self._tree_cache or {}
+        if "ancestors" in cache:
+            return cache["ancestors"]
+        if "parent" not in cache:
+            return None
+        parent = cache["parent"]
+        if parent is None:
+            return []
+        ancestors = parent.__cached_ancestors()
+        if ancestors is None:
+            return None
+        return ancestors + [parent]
+
+
+class CountedTreeNode(TreeNode):
+    """
+    A TreeNode that keeps count of its children and descendants in columns of its
+    own, so they can be read without counting.
+
+    The counts are kept up to date by adjusting only the affected ancestors whenever
+    nodes are created, moved (by changing their parent, with ``relocate()`` or with
+    ``move_to()``), created with ``bulk_create_tree()``, or deleted with ``delete()`` or
+    ``delete_subtrees()``.
+    Updates that bypass those (like ``QuerySet.delete()``) leave them stale; the
+    ``rebuild_tree_counts`` command recounts everything. Counts on instances already
+    in memory aren't updated; reload them to see changes.
+    """
+
+    child_count = models.PositiveIntegerField(default=0, editable=False)
+    descendant_count = models.PositiveIntegerField(default=0, editable=False)
+
+    class Meta(TreeNode.Meta):
+        abstract = True
+
+    def save(self, *args, **kwargs):  # pylint: disable=arguments-differ
+        using = kwargs.get("using") or router.db_for_write(
+            self.__class__, instance=self
+        )
+        with atomic(using=using):
+            return super().save(*args, **kwargs)
+
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, forced_update):
+        # The counts are only ever adjusted in the database, relative to what's
+        # already there, so never overwrite them with what's in memory.
+        values = [
+            value
+            for value in values
+            if value[0].attname not in ("child_count", "descendant_count")
+        ]
+        return super()._do_update(
+            base_qs, using, pk_val, values, update_fields, forced_update
+        )
+
+
+class ParentDescriptor(ForwardManyToOneDescriptor):
+    # Reads the parent through the foreign key, except that a newly assigned
+    # parent only takes effect on the next save(), as with any other TreeNode
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self
+        new_parent = instance._new_parent()
+        if new_parent is not UNCHANGED:
+            return new_parent
+        if instance._tree_cache and "parent" in instance._tree_cache:
+            return instance._tree_cache["parent"]
+        return super().__get__(instance, cls)
+
+    def __set__(self, instance, value):
+        TreeNode.parent.fset(instance, value)
+
+
+class ParentField(models.ForeignKey):
+    """
+    The foreign key behind ParentLinkedTreeNode's ``parent``, which mirrors
+    ``tree_path`` rather than being set directly.
+    """
+
+    forward_related_accessor_class = ParentDescriptor
+
+    def __init__(self, to, **kwargs):
+        kwargs.setdefault("on_delete", models.DO_NOTHING)
+        super().__init__(to, **kwargs)
+
+
+class ParentLinkedTreeNode(TreeNode):
+    """
+    A TreeNode that also keeps a ``parent`` foreign key to its parent node, so that
+    ``parent``, ``children``, ``siblings`` and ``roots()`` are plain btree-indexed
+    equality lookups, and ``select_related("parent")`` works.
+
+    The key is kept in step with ``tree_path`` whenever nodes are saved under a new
+    parent, relocated, moved with ``move_to()`` or created with
+    ``bulk_create_tree()``. Updates that bypass those (like ``QuerySet.update()`` of
+    ``tree_path``, or the triggers installed by InstallTreeTriggers moving
+    descendants, which keep their parents anyway) leave it as it was. It has no
+    database constraint, since ``tree_path`` stays the source of truth: deleting a
+    node leaves its children pointing at it, just as their paths still do.
+    """
+
+    parent = ParentField(
+        "self",
+        null=True,
+        blank=True,
+        editable=False,
+        db_constraint=False,
+        related_name="+",
+    )
+
+    _moved_fields = ("tree_path", "parent")
+
+    class Meta(TreeNode.Meta):
+        abstract = True
+
+    def _link_parent(self, parent):
+        self.parent_id = None if parent is None else parent.pk
+        self._meta.get_field("parent").set_cached_value(self, parent)
+
+    def relocate(self, *, after=None, before=None):
+        super().relocate(after=after, before=before)
+        if self._new_parent() is UNCHANGED:
+            # We've been given a path straight away, between our new siblings
+            field = self._meta.get_field("parent")
+            self.parent_id = (after or before).parent_id
+            if field.is_cached(self):
+                field.delete_cached_value(self)
+
+    def save(self, *args, **kwargs):  # pylint: disable=arguments-differ
+        new_parent = self._new_parent()
+        if new_parent is not UNCHANGED:
+            self._link_parent(new_parent)
+        return super().save(*args, **kwargs)
+
+    @property
+    def children(self):
+        if self._tree_cache and "children" in self._tree_cache:
+            return self._tree_cache["children"]
+        return self.__class__.objects.filter(parent=self)
+
+    @property
+    def siblings(self):
+        siblings = super().siblings
+        if isinstance(siblings, list):
+            return siblings
+        return self.__class__.objects.filter(parent_id=self.parent_id).exclude(
+            pk=self.pk
+        )
@@ -0,0 +1,341 @@
+from django.db.backends.utils import truncate_name
+from django.db.migrations.operations.base import Operation
+
+from .codecs import PAD_LENGTH, get_codec
+
+# Longest identifier PostgreSQL will accept without truncating it itself
+MAX_NAME_LENGTH = 63
+
+
+# The label that asks the triggers installed by InstallTreeTriggers to allocate a
+# real one in its place
+NEXT_LABEL = "_next"
+
+
+def allocator_function_name(db_table):
+    return truncate_name("djpgtree_next_{}".format(db_table), MAX_NAME_LENGTH)
+
+
+def trigger_name(db_table, kind):
+    return truncate_name("djpgtree_{}_{}".format(db_table, kind), MAX_NAME_LENGTH)
+
+
+class CreateTreePathAllocator(Operation):
+    """
+    Create a path allocation function specialised to one TreeNode model's table.
+
+    Unlike the generic ``djpgtree_next`` function, which has to build its query
+    with ``EXECUTE`` on every call, this function's query is planned once per
+    session, and finds the highest existing sibling with a backwards range scan over
+    the btree index backing ``tree_path``'s unique constraint rather than an lquery
+    match. Set ``path_allocator = "table"`` on the model to use it.
+
+    The function reads and writes labels in the given codec, which should match the
+    model's ``label_codec``; run the operation again to replace it if that changes.
+    """
+
+    reversible = True
+
+    def __init__(self, model_name, codec="decimal"):
+        self.model_name = model_name
+        self.codec = codec
+
+    def deconstruct(self):
+        kwargs = {}
+        if self.codec != "decimal":
+            kwargs["codec"] = self.codec
+        return (self.__class__.__name__, [self.model_name], kwargs)
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.execute(self.create_sql(model, schema_editor, self.codec))
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.execute(
+                "DROP FUNCTION {}(ltree, bigint, int)".format(
+                    allocator_function_name(model._meta.db_table)
+                )
+            )
+
+    def describe(self):
+        return "Create tree path allocator for {}".format(self.model_name)
+
+    @property
+    def migration_name_fragment(self):
+        return "{}_tree_path_allocator".format(self.model_name.lower())
+
+    @staticmethod
+    def create_sql(model, schema_editor, codec="decimal"):
+        codec = get_codec(codec)
+        column = model._meta.get_field("tree_path").column
+        return """
+            CREATE OR REPLACE FUNCTION {function}(
+                prefix ltree,
+                gap bigint,
+                pad_length int
+            ) RETURNS ltree AS $function$
+                DECLARE
+                    previous_highest ltree;
+                BEGIN
+                    -- The greatest path under the prefix always lies within the
+                    -- subtree of the highest existing sibling, so the first row of
+                    -- a backwards scan over the prefix's range gives us that
+                    -- sibling. No label can sort after a run of 'z's, so
+                    -- appending one bounds the range from above.
+                    IF prefix = ''::ltree THEN
+                        SELECT subpath({column}, 0, 1) INTO previous_highest
+                        FROM {table}
+                        ORDER BY {column} DESC LIMIT 1;
+                    ELSE
+                        SELECT subpath({column}, 0, nlevel(prefix) + 1)
+                        INTO previous_highest
+                        FROM {table}
+                        WHERE {column} > prefix
+                            AND {column} < prefix || repeat('z', 255)
+                        ORDER BY {column} DESC LIMIT 1;
+                    END IF;
+
+                    IF previous_highest IS NULL THEN
+                        RETURN prefix || {first_label};
+                    ELSE
+                        RETURN prefix || {next_label};
+                    END IF;
+                END
+            $function$ LANGUAGE plpgsql;
+        """.format(
+            function=allocator_function_name(model._meta.db_table),
+            table=schema_editor.quote_name(model._meta.db_table),
+            column=schema_editor.quote_name(column),
+            first_label=codec.sql_encode("gap", "pad_length"),
+            next_label=codec.sql_encode(
+                "{} + gap".format(
+                    codec.sql_decode("subpath(previous_highest, -1)::text")
+                ),
+                "pad_length",
+            ),
+        )
+
+
+class ReencodeTreePaths(Operation):
+    """
+    Rewrite every label in a TreeNode model's tree paths from one codec to another,
+    keeping their values, in a single UPDATE.
+
+    Change the model's ``label_codec`` alongside this, and if it uses the "table"
+    allocator, follow this with a CreateTreePathAllocator for the new codec. The
+    migration needs to depend on django_pgtree's ``0003_label_codecs``.
+    """
+
+    reversible = True
+
+    def __init__(self, model_name, from_codec, to_codec):
+        self.model_name = model_name
+        self.from_codec = from_codec
+        self.to_codec = to_codec
+
+    def deconstruct(self):
+        return (
+            self.__class__.__name__,
+            [self.model_name, self.from_codec, self.to_codec],
+            {},
+        )
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.execute(
+                self.reencode_sql(model, schema_editor, self.from_codec, self.to_codec)
+            )
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.execute(
+                self.reencode_sql(model, schema_editor, self.to_codec, self.from_codec)
+            )
+
+    def describe(self):
+        return "Re-encode tree paths of {} from {} to {}".format(
+            self.model_name, self.from_codec, self.to_codec
+        )
+
+    @property
+    def migration_name_fragment(self):
+        return "{}_reencode_{}".format(self.model_name.lower(), self.to_codec)
+
+    @staticmethod
+    def reencode_sql(model, schema_editor, from_codec, to_codec):
+        # The codecs' labels for the same value always differ in length, so no
+        # rewritten path can clash with one that's yet to be rewritten.
+        from_codec, to_codec = get_codec(from_codec), get_codec(to_codec)
+        column = schema_editor.quote_name(model._meta.get_field("tree_path").column)
+        return """
+            UPDATE {table} SET {column} = text2ltree((
+                SELECT string_agg({label}, '.' ORDER BY labels.position)
+                FROM unnest(string_to_array({column}::text, '.'))
+                    WITH ORDINALITY AS labels (label, position)
+            ))
+            WHERE {column} <> ''::ltree
+        """.format(
+            table=schema_editor.quote_name(model._meta.db_table),
+            column=column,
+            label=to_codec.sql_encode(
+                from_codec.sql_decode("labels.label"), PAD_LENGTH
+            ),
+        )
+
+
+class InstallTreeTriggers(Operation):
+    """
+    Install triggers that keep a TreeNode model's table consistent however it's
+    written to, whether through the ORM, bulk updates or raw SQL.
+
+    A row inserted or updated with a path whose last label is ``_next`` gets a real
+    label allocated in its place, after its existing siblings. After any UPDATE that
+    changes paths, the descendants of each moved node that the UPDATE didn't move
+    itself are moved along with it, in one statement. Set ``tree_triggers = True``
+    on the model to have it rely on them rather than doing that work itself.
+
+    The allocation uses ``djpgtree_next``, so, like the "generic" allocator, it
+    needs the column to be called ``tree_path``. Needs PostgreSQL 10 or later.
+    """
+
+    reversible = True
+
+    def __init__(self, model_name, codec="decimal"):
+        self.model_name = model_name
+        self.codec = codec
+
+    def deconstruct(self):
+        kwargs = {}
+        if self.codec != "decimal":
+            kwargs["codec"] = self.codec
+        return (self.__class__.__name__, [self.model_name], kwargs)
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.execute(self.create_sql(model, schema_editor, self.codec))
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.execute(self.drop_sql(model, schema_editor))
+
+    def describe(self):
+        return "Install tree triggers for {}".format(self.model_name)
+
+    @property
+    def migration_name_fragment(self):
+        return "{}_tree_triggers".format(self.model_name.lower())
+
+    @staticmethod
+    def create_sql(model, schema_editor, codec="decimal"):
+        from .models import GAP
+
+        codec = get_codec(codec)
+        db_table = model._meta.db_table
+        return """
+            CREATE OR REPLACE FUNCTION {allocate}() RETURNS trigger AS $function$
+                DECLARE
+                    prefix ltree;
+                BEGIN
+                    IF nlevel(NEW.{column}) = 0 THEN
+                        RETURN NEW;
+                    ELSIF subpath(NEW.{column}, -1)::text <> '{next_label}' THEN
+                        RETURN NEW;
+                    END IF;
+
+                    IF nlevel(NEW.{column}) = 1 THEN
+                        prefix = ''::ltree;
+                    ELSE
+                        prefix = subpath(NEW.{column}, 0, nlevel(NEW.{column}) - 1);
+                    END IF;
+                    -- The same lock that path_lock takes, so that allocations
+                    -- under the same parent can't pick the same label
+                    PERFORM pg_advisory_xact_lock(
+                        hashtext('{lock_table}:' || prefix::text)
+                    );
+                    NEW.{column} = djpgtree_next(TG_RELID::regclass, prefix, {args});
+                    RETURN NEW;
+                END
+            $function$ LANGUAGE plpgsql;
+
+            CREATE OR REPLACE FUNCTION {move}() RETURNS trigger AS $function$
+                BEGIN
+                    -- Our own UPDATE below doesn't need following up
+                    IF pg_trigger_depth() > 1 THEN
+                        RETURN NULL;
+                    END IF;
+
+                    -- Rows under a moved node that weren't updated themselves
+                    -- follow it, under the nearest ancestor that moved if several
+                    -- did.
+                    UPDATE {table} AS node
+                    SET {column} = moves.new_path
+                        || subpath(node.{column}, nlevel(moves.old_path))
+                    FROM (
+                        SELECT DISTINCT ON (descendant.{pk})
+                            descendant.{pk} AS pk,
+                            old_rows.{column} AS old_path,
+                            new_rows.{column} AS new_path
+                        FROM old_rows
+                        JOIN new_rows ON new_rows.{pk} = old_rows.{pk}
+                        JOIN {table} AS descendant
+                            ON descendant.{column} <@ old_rows.{column}
+                        WHERE new_rows.{column} IS DISTINCT FROM old_rows.{column}
+                            AND descendant.{pk} NOT IN (SELECT {pk} FROM new_rows)
+                        ORDER BY descendant.{pk}, nlevel(old_rows.{column}) DESC
+                    ) AS moves
+                    WHERE node.{pk} = moves.pk;
+                    RETURN NULL;
+                END
+            $function$ LANGUAGE plpgsql;
+
+            CREATE TRIGGER {allocate}
+            BEFORE INSERT OR UPDATE OF {column} ON {table}
+            FOR EACH ROW EXECUTE PROCEDURE {allocate}();
+
+            CREATE TRIGGER {move}
+            AFTER UPDATE ON {table}
+            REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE PROCEDURE {move}();
+        """.format(
+            allocate=trigger_name(db_table, "allocate"),
+            move=trigger_name(db_table, "move"),
+            table=schema_editor.quote_name(db_table),
+            lock_table=db_table.replace("'", "''"),
+            column=schema_editor.quote_name(model._meta.get_field("tree_path").column),
+            pk=schema_editor.quote_name(model._meta.pk.column),
+            next_label=NEXT_LABEL,
+            args=", ".join(
+                [str(GAP), str(PAD_LENGTH)]
+                + ([] if codec.name == "decimal" else ["'{}'".format(codec.name)])
+            ),
+        )
+
+    @staticmethod
+    def drop_sql(model, schema_editor):
+        db_table = model._meta.db_table
+        return """
+            DROP TRIGGER {move} ON {table};
+            DROP TRIGGER {allocate} ON {table};
+            DROP FUNCTION {move}();
+            DROP FUNCTION {allocate}();
+        """.format(
+            allocate=trigger_name(db_table, "allocate"),
+            move=trigger_name(db_table, "move"),
+            table=schema_editor.quote_name(db_table),
+        )
@@ -0,0 +1,14 @@
+from django.dispatch import Signal
+
+# Sent when a TreeNode save has to wait for, or retry after, another transaction
+# allocating a tree path under the same parent. Receivers get the instance being
+# saved, the kind of contention ("lock" or "retry"), the parent_path being
+# allocated under, and which attempt this was.
+tree_path_contention = Signal()
+
+# Sent before and after TreeQuerySet.delete_subtrees() deletes whole subtrees in
+# one statement, in place of pre_delete and post_delete for each row. Receivers get
+# the paths of the subtrees' roots and the database alias as using; post_subtree_delete
+# receivers also get the number of rows deleted as count.
+pre_subtree_delete = Signal()
+post_subtree_delete = Signal()
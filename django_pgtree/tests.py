@@ -1,4 +1,26 @@
+import pickle
+import threading
+
 import pytest
+from django.core.management import call_command
+from django.db import IntegrityError, connection
+from django.db.models import Max, Min, QuerySet
+from django.db.models.deletion import ProtectedError
+from django_pgtree.codecs import PAD_LENGTH, Base62Codec
+from django_pgtree.fields import TreePath
+from django_pgtree.indexes import TreePathGistIndex, tree_path_indexes
+from django_pgtree.loader import load_tree
+from django_pgtree.lquery import LQuery, LTxtQuery
+from django_pgtree.models import GAP, common_ancestor_path
+from django_pgtree.operations import InstallTreeTriggers
+from django_pgtree.signals import (
+    post_subtree_delete,
+    pre_subtree_delete,
+    tree_path_contention,
+)
+from testproject.testapp.models import CountedTestModel as C
+from testproject.testapp.models import NoteTestModel as N
+from testproject.testapp.models import ParentLinkedTestModel as L
 from testproject.testapp.models import TestModel as T
 
 pytestmark = pytest.mark.django_db
@@ -141,3 +163,900 @@ def test_ordering_past_10():
     for i in range(1, 12):
         T.objects.create(name=str(i))
     assert [x.name for x in T.objects.all()] == [str(x) for x in range(1, 12)]
+
+
+def test_bulk_create_tree(animal):
+    mammal = T.objects.get(name="Mammal")
+    fish = T(name="Fish", parent=animal)
+    T.objects.bulk_create_tree(
+        [
+            T(name="Shark", parent=fish),
+            T(name="Platypus", parent=mammal),
+            fish,
+            T(name="Tuna", parent=fish),
+            T(name="Fungus"),
+        ]
+    )
+    assert [x.name for x in mammal.children] == [
+        "Cat",
+        "Dog",
+        "Seal",
+        "Bear",
+        "Platypus",
+    ]
+    assert [x.name for x in animal.children] == ["Mammal", "Marsupial", "Fish"]
+    assert [x.name for x in fish.children] == ["Shark", "Tuna"]
+    assert [x.name for x in T.objects.roots()] == ["Animal", "Plant", "Fungus"]
+
+
+def test_bulk_create_tree_labels_match_save():
+    root = T.objects.create(name="Root")
+    first, second = T.objects.bulk_create_tree(
+        [T(name="First", parent=root), T(name="Second", parent=root)]
+    )
+    third = T.objects.create(name="Third", parent=root)
+    assert [x.tree_path for x in (first, second, third)] == [
+        root.tree_path + [str(n * GAP).zfill(PAD_LENGTH)] for n in (1, 2, 3)
+    ]
+    second.save()
+    second.refresh_from_db()
+    assert second.tree_path == root.tree_path + [str(2 * GAP).zfill(PAD_LENGTH)]
+
+
+def test_create_is_single_query(animal, django_assert_num_queries):
+    with django_assert_num_queries(1):
+        bird = T.objects.create(name="Bird", parent=animal)
+    assert bird.tree_path[:-1] == animal.tree_path
+    assert [x.name for x in animal.children] == ["Mammal", "Marsupial", "Bird"]
+
+
+def test_reparent_reads_back_tree_path(animal):
+    marsupial = T.objects.get(name="Marsupial")
+    mammal = T.objects.get(name="Mammal")
+    marsupial.parent = mammal
+    marsupial.save()
+    tree_path = marsupial.tree_path
+    marsupial.refresh_from_db()
+    assert marsupial.tree_path == tree_path
+
+    # Saving again mustn't allocate yet another path under the new parent
+    marsupial.save()
+    marsupial.refresh_from_db()
+    assert marsupial.tree_path == tree_path
+
+
+def test_reparent_with_update_fields(animal):
+    marsupial = T.objects.get(name="Marsupial")
+    mammal = T.objects.get(name="Mammal")
+    marsupial.name = "Pouched mammal"
+    marsupial.parent = mammal
+    marsupial.save(update_fields=["name"])
+    marsupial.refresh_from_db()
+    assert marsupial.name == "Pouched mammal"
+    assert marsupial.parent == mammal
+    assert T.objects.get(name="Kangaroo").tree_path[:-1] == marsupial.tree_path
+
+
+def test_table_allocator_matches_generic(animal):
+    mammal = T.objects.get(name="Mammal")
+    cat = T.objects.get(name="Cat")
+    with connection.cursor() as cursor:
+        for prefix in ([], mammal.tree_path, cat.tree_path):
+            cursor.execute(
+                "SELECT djpgtree_next(%s, %s, %s, %s)::text, "
+                "djpgtree_next_testapp_testmodel(%s, %s, %s)::text",
+                [T._meta.db_table, ".".join(prefix), GAP, PAD_LENGTH]
+                + [".".join(prefix), GAP, PAD_LENGTH],
+            )
+            generic, table = cursor.fetchone()
+            assert generic == table
+
+
+def test_table_allocator(animal, monkeypatch):
+    monkeypatch.setattr(T, "path_allocator", "table")
+    mammal = T.objects.get(name="Mammal")
+    T.objects.create(name="Platypus", parent=mammal)
+    T.objects.create(name="Fungus")
+    assert [x.name for x in mammal.children] == [
+        "Cat",
+        "Dog",
+        "Seal",
+        "Bear",
+        "Platypus",
+    ]
+    assert [x.name for x in T.objects.roots()] == ["Animal", "Plant", "Fungus"]
+
+
+def test_relocate_moves_descendants(animal):
+    mammal = T.objects.get(name="Mammal")
+    mammal.relocate(before=animal)
+    mammal.save()
+    assert [x.name for x in T.objects.roots()] == ["Mammal", "Animal", "Plant"]
+    assert [x.name for x in mammal.children] == ["Cat", "Dog", "Seal", "Bear"]
+
+
+def test_counter_allocator(animal, monkeypatch):
+    monkeypatch.setattr(T, "path_allocator", "counter")
+    mammal = T.objects.get(name="Mammal")
+    marsupial = T.objects.get(name="Marsupial")
+    T.objects.create(name="Platypus", parent=mammal)
+    T.objects.create(name="Walrus", parent=mammal)
+    assert [x.name for x in mammal.children] == [
+        "Cat",
+        "Dog",
+        "Seal",
+        "Bear",
+        "Platypus",
+        "Walrus",
+    ]
+
+    # Labels assigned outside the counter mustn't be handed out again
+    T.objects.bulk_create_tree([T(name="Narwhal", parent=mammal)])
+    marsupial.parent = mammal
+    marsupial.save()
+    T.objects.create(name="Wombat", parent=marsupial)
+    T.objects.create(name="Orca", parent=mammal)
+    assert [x.name for x in mammal.children] == [
+        "Cat",
+        "Dog",
+        "Seal",
+        "Bear",
+        "Platypus",
+        "Walrus",
+        "Narwhal",
+        "Marsupial",
+        "Orca",
+    ]
+    assert [x.name for x in marsupial.children] == ["Koala", "Kangaroo", "Wombat"]
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.parametrize(
+    "config", [{"path_lock": True}, {"path_retries": 50}], ids=["lock", "retry"]
+)
+def test_concurrent_allocation(config, monkeypatch):
+    for name, value in config.items():
+        monkeypatch.setattr(T, name, value)
+    root = T.objects.create(name="Root")
+    contention = []
+    errors = []
+
+    def on_contention(sender, kind, **kwargs):
+        contention.append(kind)
+
+    def worker(n):
+        try:
+            for i in range(25):
+                T.objects.create(name="{}-{}".format(n, i), parent=root)
+        except Exception as e:  # pylint: disable=broad-except
+            errors.append(e)
+        finally:
+            connection.close()
+
+    tree_path_contention.connect(on_contention, sender=T)
+    try:
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        tree_path_contention.disconnect(on_contention, sender=T)
+
+    assert errors == []
+    assert root.children.count() == 200
+    assert set(contention) <= {"lock", "retry"}
+
+
+def test_retries_only_tree_path_collisions(monkeypatch):
+    monkeypatch.setattr(T, "path_retries", 5)
+    contention = []
+
+    def on_contention(sender, kind, **kwargs):
+        contention.append(kind)
+
+    tree_path_contention.connect(on_contention, sender=T)
+    try:
+        with pytest.raises(IntegrityError):
+            T.objects.create(name=None)
+    finally:
+        tree_path_contention.disconnect(on_contention, sender=T)
+    assert contention == []
+
+
+def test_relocate_rebalances_when_out_of_room():
+    root = T.objects.create(name="Root")
+    first = T.objects.create(name="First", parent=root)
+    last = T.objects.create(name="Last", parent=root)
+    T.objects.create(name="Child", parent=last)
+    names = []
+    for i in range(40):
+        node = T.objects.create(name=str(i), parent=root)
+        node.relocate(after=first)
+        node.save()
+        names.insert(0, str(i))
+    assert [x.name for x in root.children] == ["First", *names, "Last"]
+    assert [x.name for x in T.objects.get(name="Last").children] == ["Child"]
+
+
+def test_rebalance_tree_command(animal):
+    mammal = T.objects.get(name="Mammal")
+    cat = T.objects.get(name="Cat")
+    for i in range(12):
+        node = T.objects.create(name=str(i), parent=mammal)
+        node.relocate(after=cat)
+        node.save()
+    call_command("rebalance_tree", "testapp.TestModel", verbosity=0)
+    labels = [int(x.tree_path[-1]) for x in mammal.children]
+    assert all(b - a == GAP for a, b in zip(labels, labels[1:]))
+    assert [x.name for x in mammal.children][:3] == ["Cat", "11", "10"]
+
+
+def test_rebalance_tree_command_nested(animal):
+    mammal = T.objects.get(name="Mammal")
+    cat = T.objects.get(name="Cat")
+    kitten = T.objects.create(name="Kitten", parent=cat)
+    for parent, first in ((mammal, cat), (cat, kitten)):
+        for i in range(12):
+            node = T.objects.create(name=str(i), parent=parent)
+            node.relocate(after=first)
+            node.save()
+    call_command("rebalance_tree", "testapp.TestModel", verbosity=0)
+    for parent in (mammal, T.objects.get(name="Cat")):
+        labels = [int(x.tree_path[-1]) for x in parent.children]
+        assert all(b - a == GAP for a, b in zip(labels, labels[1:]))
+    assert [x.name for x in T.objects.get(name="Cat").children][:2] == ["Kitten", "11"]
+
+
+def test_rebalance_rejects_filtered_queryset(animal):
+    with pytest.raises(ValueError):
+        T.objects.filter(name="Mammal").rebalance()
+
+
+def test_reorder_children(animal):
+    mammal = T.objects.get(name="Mammal")
+    cat, dog, seal, bear = mammal.children
+    T.objects.create(name="Kitten", parent=cat)
+    mammal.reorder_children([seal, cat, bear, dog])
+    assert [x.name for x in mammal.children] == ["Seal", "Cat", "Bear", "Dog"]
+    assert [x.name for x in cat.children] == ["Kitten"]
+    assert cat.tree_path == T.objects.get(name="Cat").tree_path
+
+
+def test_reorder_children_needs_all_children(animal):
+    mammal = T.objects.get(name="Mammal")
+    cat, dog, seal, bear = mammal.children
+    with pytest.raises(ValueError):
+        mammal.reorder_children([seal, cat, bear])
+    assert [x.name for x in mammal.children] == ["Cat", "Dog", "Seal", "Bear"]
+
+
+def test_reorder_rejects_filtered_queryset(animal):
+    mammal = T.objects.get(name="Mammal")
+    cat, dog, seal, bear = mammal.children
+    with pytest.raises(ValueError):
+        T.objects.filter(name="Cat").reorder([seal, cat, bear, dog])
+    assert [x.name for x in mammal.children] == ["Cat", "Dog", "Seal", "Bear"]
+
+
+def test_reorder_roots(animal):
+    plant = T.objects.get(name="Plant")
+    T.objects.reorder([plant, animal])
+    assert [x.name for x in T.objects.roots()] == ["Plant", "Animal"]
+    assert [x.name for x in animal.children] == ["Mammal", "Marsupial"]
+
+
+def test_iter_descendants(animal):
+    assert [x.name for x in animal.iter_descendants(chunk_size=2)] == [
+        x.name for x in animal.descendants
+    ]
+    events = [(event, x.name) for event, x in animal.iter_descendants(nested=True)]
+    assert events[:4] == [
+        ("enter", "Mammal"),
+        ("enter", "Cat"),
+        ("leave", "Cat"),
+        ("enter", "Dog"),
+    ]
+    assert events[-4:] == [
+        ("leave", "Koala"),
+        ("enter", "Kangaroo"),
+        ("leave", "Kangaroo"),
+        ("leave", "Marsupial"),
+    ]
+    assert len(events) == 16
+
+
+def test_keyset_paginate(animal):
+    names = []
+    after = None
+    while True:
+        page = list(T.objects.keyset_paginate(3, after_path=after))
+        if not page:
+            break
+        names += [x.name for x in page]
+        after = page[-1].tree_path
+    assert names == [x.name for x in T.objects.all()]
+
+
+def test_move_to(animal):
+    plant = T.objects.get(name="Plant")
+    marsupial = T.objects.get(name="Marsupial")
+    moved = T.objects.filter(name__in=["Mammal", "Cat", "Koala"]).move_to(plant)
+    assert moved == 2
+    assert [x.name for x in plant.children] == ["Mammal", "Koala"]
+    mammal = T.objects.get(name="Mammal")
+    assert [x.name for x in mammal.children] == ["Cat", "Dog", "Seal", "Bear"]
+    assert [x.name for x in marsupial.children] == ["Kangaroo"]
+
+    T.objects.filter(name="Koala").move_to(None)
+    assert [x.name for x in T.objects.roots()] == ["Animal", "Plant", "Koala"]
+    assert not hasattr(T.objects, "move_to")
+
+
+def test_move_to_own_descendant(animal):
+    cat = T.objects.get(name="Cat")
+    with pytest.raises(ValueError):
+        T.objects.filter(name__in=["Mammal", "Plant"]).move_to(cat)
+    assert [x.name for x in cat.ancestors] == ["Animal", "Mammal"]
+
+
+def test_as_tree(animal, django_assert_num_queries):
+    with django_assert_num_queries(1):
+        roots = T.objects.as_tree()
+        assert [x.name for x in roots] == ["Animal", "Plant"]
+        mammal, marsupial = roots[0].children
+        assert [x.name for x in mammal.children] == ["Cat", "Dog", "Seal", "Bear"]
+        cat = mammal.children[0]
+        assert cat.parent is mammal
+        assert [x.name for x in cat.ancestors] == ["Animal", "Mammal"]
+        assert [x.name for x in cat.siblings] == ["Dog", "Seal", "Bear"]
+        assert [x.name for x in marsupial.siblings] == ["Mammal"]
+        assert [x.name for x in roots[0].siblings] == ["Plant"]
+        assert roots[0].parent is None
+
+
+def test_as_tree_subtree(animal):
+    mammal = T.objects.get(name="Mammal")
+    (top,) = T.objects.filter(tree_path__descendant_of=mammal.tree_path).as_tree()
+    assert top == mammal
+    assert [x.name for x in top.children] == ["Cat", "Dog", "Seal", "Bear"]
+    # The parent wasn't fetched, so this falls back to a query
+    assert top.parent == animal
+
+
+def test_prefetch_ancestors(animal, django_assert_num_queries):
+    with django_assert_num_queries(2):
+        cat, koala, plant = T.objects.filter(
+            name__in=["Cat", "Koala", "Plant"]
+        ).prefetch_ancestors()
+        assert [x.name for x in cat.ancestors] == ["Animal", "Mammal"]
+        assert [x.name for x in koala.ancestors] == ["Animal", "Marsupial"]
+        assert plant.ancestors == []
+        assert cat.parent.name == "Mammal"
+        assert plant.parent is None
+        assert cat.ancestors[0] is koala.ancestors[0]
+        assert [x.name for x in cat.parent.ancestors] == ["Animal"]
+
+
+def test_prefetch_children(animal, django_assert_num_queries):
+    with django_assert_num_queries(2):
+        (top,) = T.objects.filter(name="Animal").prefetch_children(depth=2)
+        mammal, marsupial = top.children
+        assert [x.name for x in mammal.children] == ["Cat", "Dog", "Seal", "Bear"]
+        assert [x.name for x in marsupial.children] == ["Koala", "Kangaroo"]
+        assert mammal.parent is top
+    # Any deeper, and we're back to querying
+    assert isinstance(mammal.children[0].children, QuerySet)
+
+
+def test_prefetch_children_of_several(animal, django_assert_num_queries):
+    with django_assert_num_queries(2):
+        mammal, marsupial, plant = T.objects.filter(
+            name__in=["Mammal", "Marsupial", "Plant"]
+        ).prefetch_children()
+        assert [x.name for x in mammal.children] == ["Cat", "Dog", "Seal", "Bear"]
+        assert [x.name for x in marsupial.children] == ["Koala", "Kangaroo"]
+        assert plant.children == []
+
+
+def test_matches_any_lquery(animal):
+    mammal = T.objects.get(name="Mammal")
+    plant = T.objects.get(name="Plant")
+    assert [
+        x.name
+        for x in T.objects.filter(
+            tree_path__matches_any_lquery=[
+                [*mammal.tree_path, "*{1}"],
+                [*plant.tree_path],
+            ]
+        )
+    ] == ["Cat", "Dog", "Seal", "Bear", "Plant"]
+
+
+def test_tree_path_is_list_compatible():
+    path = TreePath("a.b.c")
+    assert path == ["a", "b", "c"]
+    assert path[-1] == "c"
+    assert path[:-1] == ["a", "b"]
+    assert path[:-1] + ["d"] == TreePath("a.b.d")
+    assert ["z"] + path == ["z", "a", "b", "c"]
+    assert [*path, "*{1}"] == ["a", "b", "c", "*{1}"]
+    assert not TreePath("")
+    assert pickle.loads(pickle.dumps(path)) == path
+    assert {("a", "b", "c"): 1}.get(path) == 1
+    assert {path: 1}.get(("a", "b", "c")) == 1
+
+
+def test_tree_path_helpers():
+    path = TreePath("0001.0002.0003")
+    assert path.depth == 3
+    assert path.parent_path == TreePath("0001.0002")
+    assert path.label_int == 3
+    assert TreePath("0001.715ftgG").label_value("base62") == GAP
+    assert TreePath("0001").parent_path == []
+    assert path.startswith(["0001"])
+    assert not TreePath("00011.0002").startswith(["0001"])
+    assert sorted([path, TreePath("0001"), TreePath("0001.0001")]) == [
+        ["0001"],
+        ["0001", "0001"],
+        ["0001", "0002", "0003"],
+    ]
+
+
+def test_tree_path_loaded_from_db(animal):
+    cat = T.objects.get(name="Cat")
+    assert isinstance(cat.tree_path, TreePath)
+    assert T.objects.get(tree_path=cat.tree_path) == cat
+
+
+def test_relationship_checks(animal, django_assert_num_queries):
+    nodes = {x.name: x for x in T.objects.all()}
+    animal, mammal, cat, dog, koala = (
+        nodes[x] for x in ["Animal", "Mammal", "Cat", "Dog", "Koala"]
+    )
+    with django_assert_num_queries(0):
+        assert animal.depth == 1
+        assert cat.depth == 3
+        assert animal.is_ancestor_of(cat)
+        assert cat.is_descendant_of(mammal)
+        assert not cat.is_ancestor_of(cat)
+        assert not mammal.is_ancestor_of(koala)
+        assert cat.is_sibling_of(dog)
+        assert not cat.is_sibling_of(cat)
+        assert not cat.is_sibling_of(koala)
+        assert nodes["Plant"].is_sibling_of(animal)
+        assert common_ancestor_path([cat, dog]) == mammal.tree_path
+        assert common_ancestor_path([cat, koala, mammal]) == animal.tree_path
+        assert common_ancestor_path([mammal, cat]) == mammal.tree_path
+        assert common_ancestor_path([cat, nodes["Plant"]]) == []
+
+
+def test_base62_codec_keeps_order():
+    codec = Base62Codec()
+    values = [0, 1, 61, 62, GAP - 1, GAP, GAP * 2, 2**63 - 1]
+    labels = [codec.encode(value) for value in values]
+    assert labels == sorted(labels)
+    assert [codec.decode(label) for label in labels] == values
+    assert len(codec.encode(GAP)) == 7
+
+
+@pytest.mark.parametrize("allocator", ["generic", "counter"])
+def test_base62_labels(monkeypatch, allocator):
+    monkeypatch.setattr(T, "label_codec", "base62")
+    monkeypatch.setattr(T, "path_allocator", allocator)
+    codec = Base62Codec()
+    parent = T.objects.create(name="Parent")
+    for i in range(3):
+        T.objects.create(name=str(i), parent=parent)
+    assert parent.tree_path == [codec.encode(GAP)]
+    assert [codec.decode(x.tree_path[-1]) for x in parent.children] == [
+        GAP,
+        GAP * 2,
+        GAP * 3,
+    ]
+    new = T(name="New")
+    new.relocate(before=T.objects.get(name="0"))
+    new.save()
+    assert [x.name for x in parent.children] == ["New", "0", "1", "2"]
+
+
+def test_reencode_tree_command(animal):
+    before = [(x.name, x.tree_path) for x in T.objects.all()]
+    call_command(
+        "reencode_tree",
+        "testapp.TestModel",
+        "--from=decimal",
+        "--to=base62",
+        verbosity=0,
+    )
+    codec = Base62Codec()
+    after = [(x.name, x.tree_path) for x in T.objects.all()]
+    assert [name for name, _ in after] == [name for name, _ in before]
+    assert all(
+        [codec.decode(label) for label in new] == [int(label) for label in old]
+        for (_, old), (_, new) in zip(before, after)
+    )
+
+
+def test_reencode_tree_command_forgets_counters(animal, monkeypatch):
+    monkeypatch.setattr(T, "path_allocator", "counter")
+    T.objects.create(name="Platypus", parent=T.objects.get(name="Mammal"))
+    call_command(
+        "reencode_tree",
+        "testapp.TestModel",
+        "--from=decimal",
+        "--to=base62",
+        verbosity=0,
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT count(*) FROM djpgtree_counter WHERE table_oid = %s::regclass",
+            [T._meta.db_table],
+        )
+        assert cursor.fetchone() == (0,)
+
+
+def test_tree_path_indexes():
+    (default,) = tree_path_indexes()
+    assert default.deconstruct() == T._meta.indexes[0].deconstruct()
+    gist, depth = tree_path_indexes(siglen=128, depth=True, prefix="other")
+    path, args, kwargs = gist.deconstruct()
+    assert TreePathGistIndex(*args, **kwargs).opclasses == [
+        "gist_ltree_ops(siglen=128)"
+    ]
+    assert depth.name == "other_depth_idx"
+    assert tree_path_indexes(gist=False) == ()
+
+
+def test_depth(animal):
+    assert [x.name for x in T.objects.filter(tree_path__depth=2)] == [
+        "Mammal",
+        "Marsupial",
+    ]
+    assert T.objects.filter(tree_path__depth__gt=2).count() == 6
+    assert [x.name for x in T.objects.at_depth(1)] == ["Animal", "Plant"]
+
+
+def test_descendants_by_depth(animal):
+    animal = T.objects.get(name="Animal")
+    T.objects.create(name="Kitten", parent=T.objects.get(name="Cat"))
+    assert [x.name for x in animal.descendants_to_depth(1)] == ["Mammal", "Marsupial"]
+    assert animal.descendants_to_depth(2).count() == 8
+    assert [x.name for x in animal.descendants_at_depth(3)] == ["Kitten"]
+    with pytest.raises(ValueError):
+        animal.descendants_at_depth(0)
+
+
+def test_descendant_of_any(animal):
+    mammal = T.objects.get(name="Mammal")
+    koala = T.objects.get(name="Koala")
+    plant = T.objects.get(name="Plant")
+    assert [
+        x.name
+        for x in T.objects.filter(
+            tree_path__descendant_of_any=[mammal.tree_path, koala.tree_path]
+        )
+    ] == ["Mammal", "Cat", "Dog", "Seal", "Bear", "Koala"]
+    assert T.objects.filter(tree_path__descendant_of_any=[plant.tree_path]).count() == 1
+    assert not T.objects.filter(tree_path__descendant_of_any=[]).exists()
+
+
+def test_ancestor_of_any(animal):
+    cat = T.objects.get(name="Cat")
+    koala = T.objects.get(name="Koala")
+    assert [
+        x.name
+        for x in T.objects.filter(
+            tree_path__ancestor_of_any=[cat.tree_path, koala.tree_path]
+        )
+    ] == ["Animal", "Mammal", "Cat", "Marsupial", "Koala"]
+
+
+def test_lquery_builder():
+    assert str(LQuery.children_of(TreePath("a.b"))) == "a.b.*{1}"
+    assert str(LQuery.children_of([])) == "*{1}"
+    assert str(LQuery().any().label("a", "b").any(1)) == "*.a|b.*{1,}"
+    assert (
+        str(LQuery().path(["a"]).label("b*", negate=True).any(2, 3)) == "a.!b*.*{2,3}"
+    )
+    assert str(LTxtQuery("a") & ~LTxtQuery("b", prefix=True, ignore_case=True)) == (
+        "(a & !b*@)"
+    )
+
+
+def test_lquery_lookups(animal):
+    mammal = T.objects.get(name="Mammal")
+    one, two, three, four = (str(GAP * i).zfill(PAD_LENGTH) for i in range(1, 5))
+    pattern = LQuery().path(mammal.tree_path).label(one, negate=True)
+    assert [x.name for x in T.objects.filter(tree_path__matches_lquery=pattern)] == [
+        "Dog",
+        "Seal",
+        "Bear",
+    ]
+    pattern = LQuery().any().label(three, four)
+    assert [x.name for x in T.objects.filter(tree_path__matches_lquery=pattern)] == [
+        "Seal",
+        "Bear",
+    ]
+    query = LTxtQuery(two) & ~LTxtQuery(one)
+    assert [x.name for x in T.objects.filter(tree_path__matches_ltxtquery=query)] == [
+        "Plant"
+    ]
+    query = LTxtQuery(three) | LTxtQuery(four)
+    assert T.objects.filter(tree_path__matches_ltxtquery=query).count() == 2
+
+
+def test_with_descendant_count(animal, django_assert_num_queries):
+    with django_assert_num_queries(1):
+        counts = {x.name: x.num_descendants for x in T.objects.with_descendant_count()}
+    assert counts["Animal"] == 8
+    assert counts["Mammal"] == 4
+    assert counts["Cat"] == 0
+    assert counts["Plant"] == 0
+    # The annotation doesn't collide with the stored counts
+    C.objects.create(name="A")
+    assert [x.num_descendants for x in C.objects.with_descendant_count()] == [0]
+
+
+def test_annotate_subtree(animal):
+    nodes = {
+        x.name: x
+        for x in T.objects.roots().annotate_subtree(
+            first=Min("name"), last=Max("name"), include_self=True
+        )
+    }
+    assert (nodes["Animal"].first, nodes["Animal"].last) == ("Animal", "Seal")
+    assert (nodes["Plant"].first, nodes["Plant"].last) == ("Plant", "Plant")
+    plant = T.objects.annotate_subtree(last=Max("name")).get(name="Plant")
+    assert plant.last is None
+
+
+def counts():
+    return {x.name: (x.child_count, x.descendant_count) for x in C.objects.all()}
+
+
+def test_counts_on_create_and_delete():
+    a = C.objects.create(name="A")
+    b = C.objects.create(name="B", parent=a)
+    C.objects.create(name="C", parent=b)
+    C.objects.create(name="D", parent=a)
+    assert counts() == {"A": (2, 3), "B": (1, 1), "C": (0, 0), "D": (0, 0)}
+    # Stale counts in memory don't overwrite the real ones
+    a.name = "A2"
+    a.save()
+    C.objects.get(name="D").delete()
+    assert counts() == {"A2": (1, 2), "B": (1, 1), "C": (0, 0)}
+
+
+def test_counts_on_move():
+    a = C.objects.create(name="A")
+    b = C.objects.create(name="B", parent=a)
+    C.objects.create(name="C", parent=b)
+    d = C.objects.create(name="D")
+    b.parent = d
+    b.save()
+    assert counts() == {"A": (0, 0), "B": (1, 1), "C": (0, 0), "D": (1, 2)}
+    C.objects.filter(name="B").move_to(None)
+    assert counts() == {"A": (0, 0), "B": (1, 1), "C": (0, 0), "D": (0, 0)}
+    e = C.objects.create(name="E", parent=d)
+    b.refresh_from_db()
+    b.relocate(before=e)
+    b.save()
+    assert counts() == {"A": (0, 0), "B": (1, 1), "C": (0, 0), "D": (2, 3), "E": (0, 0)}
+
+
+def test_counts_on_bulk_create_tree():
+    a = C.objects.create(name="A")
+    b = C(name="B", parent=a)
+    C.objects.bulk_create_tree(
+        [b, C(name="C", parent=b), C(name="D", parent=b), C(name="E")]
+    )
+    assert counts() == {
+        "A": (1, 3),
+        "B": (2, 2),
+        "C": (0, 0),
+        "D": (0, 0),
+        "E": (0, 0),
+    }
+
+
+def test_rebuild_tree_counts_command():
+    a = C.objects.create(name="A")
+    b = C.objects.create(name="B", parent=a)
+    C.objects.create(name="C", parent=b)
+    C.objects.update(child_count=5, descendant_count=5)
+    call_command("rebuild_tree_counts", "testapp.CountedTestModel", batch_size=2)
+    assert counts() == {"A": (1, 2), "B": (1, 1), "C": (0, 0)}
+
+
+def test_delete_subtree(animal):
+    sent = []
+
+    def receiver(signal, sender, paths, using, **kwargs):
+        sent.append((signal, paths, kwargs.get("count")))
+
+    mammal = T.objects.get(name="Mammal")
+    pre_subtree_delete.connect(receiver, sender=T)
+    post_subtree_delete.connect(receiver, sender=T)
+    try:
+        assert mammal.delete_subtree() == (5, {"testapp.TestModel": 5})
+    finally:
+        pre_subtree_delete.disconnect(receiver, sender=T)
+        post_subtree_delete.disconnect(receiver, sender=T)
+    paths = [list(mammal.tree_path)]
+    assert sent == [
+        (pre_subtree_delete, paths, None),
+        (post_subtree_delete, paths, 5),
+    ]
+    assert [x.name for x in animal.descendants] == ["Marsupial", "Koala", "Kangaroo"]
+
+
+def test_delete_subtrees_of_nested_nodes(animal):
+    deleted = T.objects.filter(name__in=["Marsupial", "Koala", "Cat", "Plant"])
+    assert deleted.delete_subtrees(signals=None)[0] == 5
+    assert [x.name for x in T.objects.all()] == [
+        "Animal",
+        "Mammal",
+        "Dog",
+        "Seal",
+        "Bear",
+    ]
+    assert T.objects.filter(name="Mammal").delete_subtrees(signals="row")[0] == 4
+    assert not hasattr(T.objects, "delete_subtrees")
+
+
+def test_delete_subtrees_with_hidden_relation():
+    # NoteTestModel refers to L with related_name="+", which still cascades
+    root = L.objects.create(name="Root")
+    child = L.objects.create(name="Child", parent=root)
+    N.objects.create(node=child, text="Note")
+    with pytest.raises(ValueError):
+        root.delete_subtree()
+    assert root.delete_subtree(signals="row")[0] == 3
+    assert not N.objects.exists()
+
+
+def test_orphan_policies(animal, monkeypatch):
+    mammal = T.objects.get(name="Mammal")
+    monkeypatch.setattr(T, "orphan_policy", "protect")
+    with pytest.raises(ProtectedError):
+        mammal.delete()
+    T.objects.get(name="Cat").delete()
+
+    monkeypatch.setattr(T, "orphan_policy", "promote")
+    mammal.delete()
+    assert [x.name for x in animal.children] == [
+        "Marsupial",
+        "Dog",
+        "Seal",
+        "Bear",
+    ]
+
+    monkeypatch.setattr(T, "orphan_policy", "cascade")
+    T.objects.get(name="Marsupial").delete()
+    assert [x.name for x in animal.descendants] == ["Dog", "Seal", "Bear"]
+
+
+def test_counts_on_delete_subtree():
+    a = C.objects.create(name="A")
+    b = C.objects.create(name="B", parent=a)
+    C.objects.create(name="C", parent=b)
+    C.objects.create(name="D", parent=a)
+    b.delete_subtree()
+    assert counts() == {"A": (1, 1), "D": (0, 0)}
+
+
+def parent_links():
+    return {
+        x.name: x.parent and x.parent.name for x in L.objects.select_related("parent")
+    }
+
+
+def test_parent_links(django_assert_num_queries):
+    a = L.objects.create(name="A")
+    b = L.objects.create(name="B", parent=a)
+    c = L.objects.create(name="C", parent=b)
+    d = L.objects.create(name="D")
+    with django_assert_num_queries(1):
+        assert parent_links() == {"A": None, "B": "A", "C": "B", "D": None}
+    assert [x.name for x in L.objects.roots()] == ["A", "D"]
+    assert [x.name for x in a.children] == ["B"]
+
+    b.parent = d
+    assert b.parent == d
+    b.save()
+    c.refresh_from_db()
+    assert c.tree_path[:-1] == b.tree_path
+    e = L.objects.create(name="E", parent=a)
+    e.relocate(before=b)
+    e.save()
+    assert [x.name for x in b.siblings] == ["E"]
+    L.objects.filter(name="B").move_to(None)
+    assert parent_links() == {"A": None, "B": None, "C": "B", "D": None, "E": "D"}
+
+
+def test_parent_links_on_bulk_create_tree():
+    a = L.objects.create(name="A")
+    b = L(name="B", parent=a)
+    L.objects.bulk_create_tree([b, L(name="C", parent=b), L(name="D")])
+    assert parent_links() == {"A": None, "B": "A", "C": "B", "D": None}
+
+
+def test_load_tree(animal):
+    rows = [
+        {"key": 2, "parent": 1, "name": "Fern"},
+        {"key": 1, "parent": None, "name": "Spore"},
+        {"key": 3, "parent": 1, "name": "Moss"},
+        {"key": 4, "parent": 2, "name": "Bracken"},
+    ]
+    plant = T.objects.get(name="Plant")
+    assert load_tree(T, rows, ["name"], parent=plant, batch_size=3) == 4
+    spore = T.objects.get(name="Spore")
+    assert spore.tree_path == [*plant.tree_path, str(GAP).zfill(PAD_LENGTH)]
+    assert [x.name for x in spore.descendants] == ["Fern", "Bracken", "Moss"]
+
+    with pytest.raises(ValueError):
+        load_tree(T, [{"key": 5, "parent": 6, "name": "Orphan"}], ["name"])
+    assert not T.objects.filter(name="Orphan").exists()
+
+
+def test_load_tree_counts_and_parent_links():
+    a = C.objects.create(name="A")
+    rows = [
+        {"key": "b", "parent": "", "name": "B"},
+        {"key": "c", "parent": "b", "name": "C"},
+    ]
+    load_tree(C, rows, ["name"], parent=a)
+    assert counts() == {"A": (1, 2), "B": (1, 1), "C": (0, 0)}
+    load_tree(L, rows, ["name"])
+    assert parent_links() == {"B": None, "C": "B"}
+
+
+def test_load_tree_command(tmp_path):
+    source = tmp_path / "tree.csv"
+    source.write_text("id,parent_id,title\n1,,A\n2,1,B\n3,,C\n")
+    call_command(
+        "load_tree",
+        "testapp.ParentLinkedTestModel",
+        str(source),
+        format="csv",
+        fields=["name=title"],
+    )
+    assert parent_links() == {"A": None, "B": "A", "C": None}
+    call_command(
+        "load_tree", "testapp.CountedTestModel", "testapp.ParentLinkedTestModel"
+    )
+    assert counts() == {"A": (1, 1), "B": (0, 0), "C": (0, 0)}
+
+
+@pytest.fixture
+def tree_triggers(monkeypatch):
+    with connection.schema_editor() as editor:
+        editor.execute(InstallTreeTriggers.create_sql(T, editor))
+    monkeypatch.setattr(T, "tree_triggers", True)
+
+
+def test_triggers_move_descendants_on_update(animal, tree_triggers):
+    plant = T.objects.get(name="Plant")
+    T.objects.filter(name="Mammal").update(tree_path=[*plant.tree_path, "_next"])
+    mammal = T.objects.get(name="Mammal")
+    assert mammal.tree_path == [*plant.tree_path, str(GAP).zfill(PAD_LENGTH)]
+    assert [x.name for x in mammal.children] == ["Cat", "Dog", "Seal", "Bear"]
+    assert [x.name for x in T.objects.get(name="Animal").descendants] == [
+        "Marsupial",
+        "Koala",
+        "Kangaroo",
+    ]
+
+
+def test_triggers_on_save(animal, tree_triggers, django_assert_num_queries):
+    plant = T.objects.get(name="Plant")
+    mammal = T.objects.get(name="Mammal")
+    with django_assert_num_queries(1):
+        node = T.objects.create(name="Fern", parent=plant)
+    assert node.tree_path == T.objects.get(name="Fern").tree_path
+    mammal.parent = plant
+    mammal.save()
+    assert mammal.tree_path == T.objects.get(name="Mammal").tree_path
+    assert [x.name for x in mammal.children] == ["Cat", "Dog", "Seal", "Bear"]
+    assert [x.name for x in plant.children] == ["Fern", "Mammal"]
@@ -0,0 +1,9 @@
+from django.db import migrations
+import django_pgtree.operations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("testapp", "0002_auto_20181011_0229")]
+
+    operations = [django_pgtree.operations.CreateTreePathAllocator("TestModel")]
@@ -0,0 +1,46 @@
+# Generated by Django 3.2.25 on 2026-10-17 00:50
+
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+import django_pgtree.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("testapp", "0003_testmodel_tree_path_allocator"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CountedTestModel",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("tree_path", django_pgtree.fields.LtreeField(unique=True)),
+                ("child_count", models.PositiveIntegerField(default=0, editable=False)),
+                (
+                    "descendant_count",
+                    models.PositiveIntegerField(default=0, editable=False),
+                ),
+                ("name", models.CharField(max_length=128)),
+            ],
+            options={
+                "ordering": ("tree_path",),
+                "abstract": False,
+            },
+        ),
+        migrations.AddIndex(
+            model_name="countedtestmodel",
+            index=django.contrib.postgres.indexes.GistIndex(
+                fields=["tree_path"], name="counted_tree_path_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 3.2.25 on 2026-10-17 00:56
+
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+import django.db.models.deletion
+import django_pgtree.fields
+import django_pgtree.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("testapp", "0004_countedtestmodel"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ParentLinkedTestModel",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("tree_path", django_pgtree.fields.LtreeField(unique=True)),
+                ("name", models.CharField(max_length=128)),
+                (
+                    "parent",
+                    django_pgtree.models.ParentField(
+                        blank=True,
+                        db_constraint=False,
+                        editable=False,
+                        null=True,
+                        on_delete=django.db.models.deletion.DO_NOTHING,
+                        related_name="+",
+                        to="testapp.parentlinkedtestmodel",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ("tree_path",),
+                "abstract": False,
+            },
+        ),
+        migrations.AddIndex(
+            model_name="parentlinkedtestmodel",
+            index=django.contrib.postgres.indexes.GistIndex(
+                fields=["tree_path"], name="linked_tree_path_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.2.25 on 2026-10-17 01:23
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("testapp", "0005_parentlinkedtestmodel"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="NoteTestModel",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("text", models.CharField(max_length=128)),
+                (
+                    "node",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="testapp.parentlinkedtestmodel",
+                    ),
+                ),
+            ],
+        ),
+    ]
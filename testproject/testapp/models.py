@@ -1,5 +1,6 @@
 from django.db import models
-from django_pgtree.models import TreeNode
+from django_pgtree.indexes import tree_path_indexes
+from django_pgtree.models import CountedTreeNode, ParentLinkedTreeNode, TreeNode
 
 
 class TestModel(TreeNode):
@@ -7,3 +8,30 @@ class TestModel(TreeNode):
 
     def __str__(self):
         return self.name
+
+
+class CountedTestModel(CountedTreeNode):
+    name = models.CharField(max_length=128)
+
+    class Meta(CountedTreeNode.Meta):
+        indexes = tree_path_indexes(prefix="counted_tree_path")
+
+    def __str__(self):
+        return self.name
+
+
+class ParentLinkedTestModel(ParentLinkedTreeNode):
+    name = models.CharField(max_length=128)
+
+    class Meta(ParentLinkedTreeNode.Meta):
+        indexes = tree_path_indexes(prefix="linked_tree_path")
+
+    def __str__(self):
+        return self.name
+
+
+class NoteTestModel(models.Model):
+    node = models.ForeignKey(
+        ParentLinkedTestModel, on_delete=models.CASCADE, related_name="+"
+    )
+    text = models.CharField(max_length=128)